@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Checks that the SQL scoring engine gives the same totals as the Python one,
+on a tracker CSV dump or on synthetic data. Exits with an error on differences.
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from adiff_to_csv import COLUMNS, process_adiff  # noqa: E402
+from filters import TagFilter, RegionFilter  # noqa: E402
+from synthetic import generate, add_generator_arguments  # noqa: E402
+from tracker_db import add_psql_arguments, connect  # noqa: E402
+from generate_user_stats import (  # noqa: E402
+    Weights, UserStats, SqlStats, calculate, prepare_row, row_sort_key)
+
+
+def write_synthetic_csv(path, options):
+    """Generates an augmented diff, extracts rows from it and writes them to a CSV."""
+    files, _ = generate(path, options.tags, options.nodes, options.ways,
+                        options.changes, options.relevant, options.grid, options.seed)
+    with open(files['tags']) as f:
+        tags = TagFilter(f)
+    with open(files['regions']) as f:
+        regions = RegionFilter(f)
+    with open(files['adiff'], 'rb') as f:
+        rows = process_adiff(f, regions, tags)
+    filename = os.path.join(path, 'tracker.csv')
+    with open(filename, 'w') as f:
+        writer = csv.DictWriter(f, [c[0] for c in COLUMNS], extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    return filename
+
+
+def python_stats(filename, weights):
+    """Scores a CSV file with the Python engine."""
+    with open(filename, 'r') as f:
+        rows = [prepare_row(r) for r in csv.DictReader(f)]
+    rows.sort(key=row_sort_key)
+    stats = UserStats()
+    calculate(rows, weights, stats)
+    return stats
+
+
+def sql_stats(conn, filename, weights):
+    """Loads a CSV file into a temporary table and scores it inside PostgreSQL."""
+    with conn.cursor() as cur, open(filename, 'r') as f:
+        cols = ',\n'.join(f'{c[0]} {c[1]}' for c in COLUMNS)
+        cur.execute("drop table if exists compare_tracker")
+        cur.execute(f"create temporary table compare_tracker ({cols})")
+        header = f.readline().strip()
+        cur.copy_expert(f"copy compare_tracker ({header}) from stdin (format csv)", f)
+    return SqlStats(conn, 'compare_tracker', weights).read()
+
+
+def find_differences(expected, found):
+    """Returns lines describing totals and columns that differ between two UserStats."""
+    errors = []
+    for k in sorted(set(expected.result) | set(found.result), key=str):
+        exp = [round(v) for v in expected.result.get(k, [0, 0])]
+        got = [round(v) for v in found.result.get(k, [0, 0])]
+        if exp != got:
+            errors.append(f'{k}: expected {exp}, got {got}')
+    for i, typ in enumerate(('node', 'way')):
+        if expected.columns[i] != found.columns[i]:
+            errors.append(f'{typ} columns: expected {sorted(expected.columns[i])}, '
+                          f'got {sorted(found.columns[i])}')
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Scores a tracker CSV dump both in Python and in PostgreSQL, '
+        'and prints differences.')
+    parser.add_argument('input', nargs='?',
+                        help='CSV file with a header, e.g. a dump of osc_tracker. '
+                        'By default, rows are made from synthetic data')
+    parser.add_argument('-w', '--weights', type=argparse.FileType('r'),
+                        default=os.path.join(os.path.dirname(__file__), '..',
+                                             'konkurs_weights.lst'),
+                        help='Definitions for weights for change types')
+    add_generator_arguments(parser)
+    add_psql_arguments(parser, required=True)
+    options = parser.parse_args()
+    weights = Weights(options.weights)
+    if not options.input:
+        options.input = write_synthetic_csv(tempfile.mkdtemp(prefix='osc_scoring_'), options)
+
+    expected = python_stats(options.input, weights)
+    conn = connect(options)
+    found = sql_stats(conn, options.input, weights)
+    conn.close()
+
+    errors = find_differences(expected, found)
+    for line in errors:
+        print(line)
+    print(f'{len(expected.result)} totals, {len(errors)} differences')
+    sys.exit(1 if errors else 0)
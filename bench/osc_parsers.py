@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Compares lxml and pyosmium readers for an hourly osmChange file."""
+import argparse
+import gzip
+import os
+import sys
+import time
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from osc_to_adiff import OscReader, OscLocationHandler  # noqa: E402
+
+
+def read_with_lxml(filename):
+    """What process_osc used to do: iterparse and read attributes of every object."""
+    count = 0
+    locs = {}
+    with gzip.open(filename) as f:
+        for _, action in etree.iterparse(f, events=['end'],
+                                         tag=['create', 'modify', 'delete']):
+            for obj in action:
+                count += 1
+                {t.get('k'): t.get('v') for t in obj.findall('tag')}
+                if obj.get('lat'):
+                    locs[obj.get('id')] = float(obj.get('lat')), float(obj.get('lon'))
+                [nd.get('ref') for nd in obj.findall('nd')]
+            action.clear()
+    return count, len(locs)
+
+
+def read_with_osmium(filename):
+    objects = []
+    OscReader(lambda obj: objects.append(obj.action)).apply_file(filename)
+    handler = OscLocationHandler()
+    handler.apply_file(filename)
+    return len(objects), len(handler.locations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Times reading an osmChange file with lxml and with pyosmium.')
+    parser.add_argument('osc', help='Hourly diff, e.g. 078123.osc.gz')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Number of runs for each reader, the best is reported')
+    options = parser.parse_args()
+
+    for name, func in (('lxml', read_with_lxml), ('osmium', read_with_osmium)):
+        best = None
+        for _ in range(options.repeat):
+            start = time.perf_counter()
+            objects, locations = func(options.osc)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f'{name:8} {best:8.3f} s, {objects} objects, {locations} node locations')
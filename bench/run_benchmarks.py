@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Runs every processing stage on synthetic data and stores timings as JSON,
+optionally comparing them to a baseline from an earlier run.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from synthetic import generate, add_generator_arguments, BBOX  # noqa: E402
+from filters import TagFilter, RegionFilter  # noqa: E402
+from tracker_db import add_psql_arguments, connect  # noqa: E402
+
+
+class StubResponse:
+    def __init__(self, content):
+        self.status_code = 200 if content else 404
+        self.content = content or b''
+        self.text = self.content.decode('utf-8')
+
+
+def stub_api(dataset):
+    """Returns a function that answers OSM API requests from the dataset."""
+    def node_xml(osm_id, version=None):
+        # Without a version, the latest one
+        snap = dataset.history.get(('n', osm_id, int(version or dataset.nodes[osm_id][0])))
+        if not snap:
+            return ''
+        tags_xml = ''.join(f'<tag k="{k}" v="{v}"/>' for k, v in snap['tags'].items())
+        return (f'<node id="{osm_id}" version="{snap["version"]}" lat="{snap["lat"]:.7f}" '
+                f'lon="{snap["lon"]:.7f}">{tags_xml}</node>')
+
+    def way_xml(osm_id, version):
+        snap = dataset.history.get(('w', osm_id, int(version)))
+        if not snap:
+            return ''
+        nds = ''.join(f'<nd ref="{r}"/>' for r in snap['refs'])
+        tags_xml = ''.join(f'<tag k="{k}" v="{v}"/>' for k, v in snap['tags'].items())
+        return f'<way id="{osm_id}" version="{version}">{nds}{tags_xml}</way>'
+
+    def api_get(url, params=None):
+        parts = urlparse(url).path.split('/')[3:]  # after /api/0.6
+        if parts[0] in ('nodes', 'ways'):
+            # Both "123" and "123v4" for a specific version
+            refs = [r.split('v') for r in params[parts[0]].split(',')]
+            if parts[0] == 'nodes':
+                body = ''.join(node_xml(int(r[0]), r[1] if len(r) > 1 else None)
+                               for r in refs if int(r[0]) in dataset.nodes)
+            else:
+                body = ''.join(way_xml(int(r[0]), r[1]) for r in refs)
+        elif parts[-1] == 'history':
+            body = node_xml(int(parts[1])) if int(parts[1]) in dataset.nodes else None
+        elif parts[0] == 'node':
+            body = node_xml(int(parts[1]), parts[2]) or None
+        elif parts[0] == 'way':
+            body = way_xml(int(parts[1]), parts[2]) or None
+        else:
+            body = None
+        return StubResponse(None if body is None else f'<osm>{body}</osm>'.encode('utf-8'))
+    return api_get
+
+
+def timed(results, name, items, func, repeat):
+    best = None
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results[name] = {
+        'seconds': round(best, 4),
+        'items': items,
+        'per_second': round(items / best, 1) if best else None,
+    }
+    print(f'{name:16} {best:9.3f} s {items:9} items {items / best:12.1f} /s')
+    return value
+
+
+def bench_filters(results, files, dataset, repeat):
+    with open(files['tags']) as f:
+        tag_filter = TagFilter(f)
+    objects = [('node', n[3]) for n in dataset.nodes.values()]
+    objects.extend(('way', w[2]) for w in dataset.ways.values())
+    timed(results, 'tag_filter', len(objects),
+          lambda: [tag_filter.get_kinds(t, tags) for t, tags in objects], repeat)
+
+    with open(files['regions']) as f:
+        regions = RegionFilter(f)
+    rnd = random.Random(1)
+    points = [(rnd.uniform(BBOX[0], BBOX[2]), rnd.uniform(BBOX[1], BBOX[3]))
+              for _ in range(len(dataset.nodes))]
+    timed(results, 'region_filter', len(points),
+          lambda: [regions.find(lon, lat) for lon, lat in points], repeat)
+
+
+def bench_osc(results, files, dataset, options):
+    """Runs init and process_osc in a separate "bench" schema."""
+    import osc_to_adiff
+    from osc_db import OscDatabase
+
+    conn = connect(options)
+    with conn.cursor() as cur:
+        cur.execute("create schema if not exists bench")
+        cur.execute("set search_path to bench")
+    with open(files['tags']) as f:
+        tags = TagFilter(f)
+    with open(files['regions']) as f:
+        regions = RegionFilter(f)
+    db = OscDatabase(conn, tags)
+    objects = dataset.extract_size
+    changes = options.changes
+
+    def init():
+        db.create_tables()
+        osc_to_adiff.InitHandler(db, tags, regions).apply_file(
+            files['extract'], locations=True)
+        conn.commit()
+
+    def process():
+        builder = osc_to_adiff.AdiffBuilder(db, tags, regions)
+        builder.api_get = stub_api(dataset)
+        builder.process_osc(files['osc'], io.BytesIO())
+        conn.rollback()
+
+    timed(results, 'init', objects, init, 1)
+    timed(results, 'process_osc', changes, process, options.repeat)
+    conn.close()
+
+
+def bench_adiff(results, files, weights_file, changes, repeat):
+    from adiff_to_csv import COLUMNS, process_adiff
+    import generate_user_stats as gus
+
+    with open(files['tags']) as f:
+        tags = TagFilter(f)
+    with open(files['regions']) as f:
+        regions = RegionFilter(f)
+
+    def process():
+        with open(files['adiff'], 'rb') as f:
+            return process_adiff(f, regions, tags)
+
+    rows = timed(results, 'adiff_to_csv', changes, process, repeat)
+    # Values are read from CSV as strings, with every column present
+    rows = [{c[0]: '' if r.get(c[0]) is None else str(r[c[0]]) for c in COLUMNS}
+            for r in rows]
+
+    with open(weights_file) as f:
+        weights = gus.Weights(f)
+
+    def stats():
+        prepared = [gus.prepare_row(dict(r)) for r in rows]
+        prepared.sort(key=gus.row_sort_key)
+        result = gus.UserStats()
+        gus.calculate(prepared, weights, result)
+        return result
+
+    result = timed(results, 'user_stats', len(rows), stats, repeat)
+    return rows, result
+
+
+def bench_sql_stats(results, path, rows, expected, weights_file, options):
+    """Scores the rows inside PostgreSQL. Returns differences from the Python engine."""
+    from adiff_to_csv import COLUMNS
+    from compare_scoring import sql_stats, find_differences
+    import generate_user_stats as gus
+
+    filename = os.path.join(path, 'tracker.csv')
+    with open(filename, 'w') as f:
+        writer = csv.DictWriter(f, [c[0] for c in COLUMNS])
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(weights_file) as f:
+        weights = gus.Weights(f)
+    conn = connect(options)
+    found = timed(results, 'sql_stats', len(rows),
+                  lambda: sql_stats(conn, filename, weights), options.repeat)
+    conn.close()
+    return find_differences(expected, found)
+
+
+def compare(results, baseline, threshold):
+    """Prints changes relative to the baseline. Returns False if something got slower."""
+    ok = True
+    print('\nComparing to the baseline:')
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['seconds']
+        change = (res['seconds'] - old) / old * 100 if old else 0
+        mark = ''
+        if change > threshold:
+            mark = '  <- slower'
+            ok = False
+        print(f'{name:16} {old:9.3f} s -> {res["seconds"]:9.3f} s ({change:+.1f}%){mark}')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks filters, osc processing, adiff_to_csv and user stats '
+        'on synthetic data. Database stages use a "bench" schema.')
+    add_generator_arguments(parser)
+    parser.add_argument('--weights', default=os.path.join(
+        os.path.dirname(__file__), '..', 'konkurs_weights.lst'), help='Weights file')
+    parser.add_argument('--data', help='Directory for generated files, default is temporary')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Number of runs for each stage, the best is reported')
+    parser.add_argument('-o', '--output', help='Write results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='Compare results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Percent of slowdown to report as a regression')
+    parser.add_argument('--smoke', action='store_true',
+                        help='Run every stage once on small data, and fail if one '
+                        'gives no result')
+    add_psql_arguments(parser)
+    options = parser.parse_args()
+    if options.smoke:
+        options.nodes, options.ways, options.changes, options.repeat = 2000, 200, 500, 1
+
+    path = options.data or tempfile.mkdtemp(prefix='osc_bench_')
+    print(f'Generating data in {path}')
+    files, dataset = generate(path, options.tags, options.nodes, options.ways,
+                              options.changes, options.relevant, options.grid, options.seed)
+    results = {}
+    bench_filters(results, files, dataset, options.repeat)
+    if options.database:
+        bench_osc(results, files, dataset, options)
+    else:
+        print('No database, skipping init and process_osc')
+    rows, stats = bench_adiff(results, files, options.weights, options.changes, options.repeat)
+    if options.smoke and (not rows or not stats.result):
+        print('Smoke run failed: no rows or no user statistics')
+        sys.exit(1)
+    if options.database:
+        errors = bench_sql_stats(results, path, rows, stats, options.weights, options)
+        if errors:
+            print('SQL scoring differs from Python:')
+            for line in errors:
+                print(line)
+            sys.exit(1)
+    else:
+        print('No database, skipping the SQL scoring check')
+
+    report = {
+        'params': {k: getattr(options, k) for k in (
+            'nodes', 'ways', 'changes', 'relevant', 'grid', 'seed', 'repeat')},
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != report['params']:
+            print('Warning: baseline was made with different parameters')
+        if not compare(results, baseline['results'], options.threshold):
+            sys.exit(1)
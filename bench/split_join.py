@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Checks indexed split/join detection against a linear scan on recorded adiffs."""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from adiff_to_csv import (  # noqa: E402
+    iter_actions, read_modified_ways, find_way_in_another_modified)
+
+
+def find_linear(way, modified_ways, is_created):
+    """The old algorithm: scan every modified way and test list membership."""
+    nodes = [n.get('ref') for n in way.findall('nd')]
+    candidate = None
+    for mway in modified_ways.ways:
+        anodes = list(mway.old_nodes if is_created else mway.new_nodes)
+        if mway.osm_id == way.get('id'):
+            continue
+        cnt_matches = len([n for n in nodes if n in anodes])
+        if nodes[0] in anodes and nodes[-1] in anodes and cnt_matches > len(nodes) / 2:
+            candidate = mway
+    return candidate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compares split/join detection results and timings.')
+    parser.add_argument('adiff', nargs='+', help='Augmented diff files')
+    options = parser.parse_args()
+
+    mismatches = 0
+    timings = [0, 0]
+    for filename in options.adiff:
+        with open(filename, 'rb') as f:
+            modified_ways = read_modified_ways(f)
+            f.seek(0)
+            for action in iter_actions(f):
+                atype = action.get('type')
+                if atype == 'create':
+                    way, is_created = action[0], True
+                elif atype == 'delete':
+                    way, is_created = action.find('old')[0], False
+                else:
+                    continue
+                if way.tag != 'way' or not way.findall('nd'):
+                    continue
+                start = time.perf_counter()
+                expected = find_linear(way, modified_ways, is_created)
+                timings[0] += time.perf_counter() - start
+                start = time.perf_counter()
+                found = find_way_in_another_modified(way, modified_ways, is_created)
+                timings[1] += time.perf_counter() - start
+                if found is not expected:
+                    mismatches += 1
+                    print(f'{filename}: way {way.get("id")} ({atype}): expected '
+                          f'{None if expected is None else expected.osm_id}, got '
+                          f'{None if found is None else found.osm_id}')
+    print(f'Linear scan: {timings[0]:.3f} s, index: {timings[1]:.3f} s, '
+          f'mismatches: {mismatches}')
+    sys.exit(1 if mismatches else 0)
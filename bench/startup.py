@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Measures startup time of every osm-changes-counter command, and which heavy
+modules each one imports, using "python -X importtime".
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from cli import COMMANDS  # noqa: E402
+
+ENTRY_POINT = os.path.join(os.path.dirname(__file__), '..', 'osm-changes-counter')
+HEAVY = ['osmium', 'shapely', 'pyproj', 'lxml', 'requests', 'psycopg2']
+
+
+def run_command(command):
+    """Runs "command --help" and returns wall time, import time and heavy modules."""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', ENTRY_POINT, command, '--help'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    imports_us = 0
+    heavy = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        parts = line.split('|')
+        name = parts[2].strip()
+        imports_us += int(parts[0].split(':')[1])
+        if name.split('.')[0] in HEAVY:
+            heavy.add(name.split('.')[0])
+    return elapsed, imports_us / 1e6, sorted(heavy)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Times "osm-changes-counter <command> --help" for every command.')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='Number of runs for each command, the best is reported')
+    options = parser.parse_args()
+
+    print(f'{"command":10} {"wall, s":>8} {"imports, s":>10}  heavy modules')
+    for command in ['--help'] + list(COMMANDS):
+        runs = [run_command(command) for _ in range(options.repeat)]
+        elapsed = min(r[0] for r in runs)
+        imports = min(r[1] for r in runs)
+        print(f'{command:10} {elapsed:8.3f} {imports:10.3f}  {", ".join(runs[0][2]) or "-"}')
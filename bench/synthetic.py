@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Generates synthetic extracts, osmChange files, augmented diffs and regions."""
+import argparse
+import gzip
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from lxml import etree
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from filters import TagFilter  # noqa: E402
+
+
+BBOX = (30.0, 59.0, 31.0, 60.0)  # minlon, minlat, maxlon, maxlat
+START_TS = datetime(2021, 10, 1, tzinfo=timezone.utc)
+FILLER_TAGS = [
+    {'highway': 'residential'}, {'building': 'yes'}, {'amenity': 'bench'},
+    {'highway': 'footway'}, {'natural': 'tree'},
+]
+
+
+class Dataset:
+    """A random but reproducible set of nodes and ways, and changes to them."""
+    def __init__(self, tag_filter, nodes=10000, ways=1000, relevant=0.3, seed=1):
+        self.rnd = random.Random(seed)
+        self.relevant = relevant
+        self.node_tags = self.list_tags(tag_filter, 'n')
+        self.way_tags = self.list_tags(tag_filter, 'w')
+        self.nodes = {}  # id -> [version, lat, lon, tags]
+        self.ways = {}  # id -> [version, [node ids], tags]
+        self.history = {}  # (type, id, version) -> snapshot, see snapshot()
+        for i in range(1, nodes + 1):
+            self.nodes[i] = [1, self.rnd.uniform(BBOX[1], BBOX[3]),
+                             self.rnd.uniform(BBOX[0], BBOX[2]), self.random_tags('n')]
+        for i in range(1, ways + 1):
+            start = self.rnd.randint(1, nodes - 20)
+            refs = list(range(start, start + self.rnd.randint(2, 20)))
+            self.ways[i] = [1, refs, self.random_tags('w')]
+        for i in self.nodes:
+            self.snapshot('n', i)
+        for i in self.ways:
+            self.snapshot('w', i)
+        self.extract_size = nodes + ways
+        self.node_count = nodes  # new ways reference only these, to have consecutive ids
+        self.next_id = nodes + ways + 1
+
+    def list_tags(self, tag_filter, typ):
+        """Returns a list of tag dicts that match the filter."""
+        result = []
+        for tag in tag_filter.kinds[typ]:
+            tags = {}
+            for part in tag.split('+'):
+                kv = part.split('=')
+                tags[kv[0]] = kv[1] if len(kv) > 1 else str(self.rnd.randint(1, 5) * 10)
+            result.append(tags)
+        return result or [{}]
+
+    def random_tags(self, typ):
+        tags = dict(self.rnd.choice(FILLER_TAGS))
+        if self.rnd.random() < self.relevant:
+            tags.update(self.rnd.choice(self.node_tags if typ == 'n' else self.way_tags))
+        return tags
+
+    def snapshot(self, typ, osm_id):
+        """Records and returns the current state of an object, with way node locations."""
+        if typ == 'n':
+            version, lat, lon, tags = self.nodes[osm_id]
+            snap = {'version': version, 'lat': lat, 'lon': lon, 'tags': dict(tags)}
+        else:
+            version, refs, tags = self.ways[osm_id]
+            snap = {'version': version, 'refs': list(refs), 'tags': dict(tags),
+                    'coords': [tuple(self.nodes[r][1:3]) for r in refs]}
+        self.history[(typ, osm_id, version)] = snap
+        return snap
+
+    def make_changes(self, count):
+        """
+        Returns a list of (action, type, id, old, new) with snapshots of the object
+        before and after the change, and updates the dataset.
+        """
+        changes = []
+        for _ in range(count):
+            r = self.rnd.random()
+            typ = 'n' if self.rnd.random() < 0.7 else 'w'
+            objects = self.nodes if typ == 'n' else self.ways
+            if r < 0.2:
+                osm_id = self.next_id
+                self.next_id += 1
+                if typ == 'n':
+                    objects[osm_id] = [1, self.rnd.uniform(BBOX[1], BBOX[3]),
+                                       self.rnd.uniform(BBOX[0], BBOX[2]), self.random_tags('n')]
+                else:
+                    start = self.rnd.randint(1, self.node_count - 20)
+                    objects[osm_id] = [1, list(range(start, start + 5)), self.random_tags('w')]
+                changes.append(('create', typ, osm_id, None, self.snapshot(typ, osm_id)))
+            else:
+                osm_id = self.rnd.choice(list(objects.keys()))
+                old = self.history[(typ, osm_id, objects[osm_id][0])]
+                obj = objects[osm_id]
+                obj[0] += 1
+                if r < 0.25 and typ == 'w':
+                    obj[2] = {}
+                    changes.append(('delete', typ, osm_id, old, self.snapshot(typ, osm_id)))
+                    # Deleted ways are not changed again
+                    del objects[osm_id]
+                else:
+                    obj[-1] = self.random_tags(typ)
+                    changes.append(('modify', typ, osm_id, old, self.snapshot(typ, osm_id)))
+        return changes
+
+
+def write_pbf(dataset, filename):
+    import osmium
+    if os.path.exists(filename):
+        os.remove(filename)
+    writer = osmium.SimpleWriter(filename)
+    for osm_id, (version, lat, lon, tags) in sorted(dataset.nodes.items()):
+        writer.add_node(osmium.osm.mutable.Node(
+            id=osm_id, version=version, location=(lon, lat), tags=tags,
+            timestamp=START_TS, changeset=1, uid=1, user='bench'))
+    for osm_id, (version, refs, tags) in sorted(dataset.ways.items()):
+        writer.add_way(osmium.osm.mutable.Way(
+            id=osm_id, version=version, nodes=refs, tags=tags,
+            timestamp=START_TS, changeset=1, uid=1, user='bench'))
+    writer.close()
+
+
+def write_osc(dataset, changes, filename):
+    root = etree.Element('osmChange', version='0.6', generator='bench')
+    rnd = random.Random(len(changes))
+    for i, (action, typ, osm_id, _, new) in enumerate(changes):
+        el = etree.SubElement(root, action)
+        ts = (START_TS + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        uid = str(rnd.randint(1, 50))
+        attrs = {'timestamp': ts, 'uid': uid, 'user': f'user{uid}', 'changeset': str(i + 2)}
+        version = str(new['version'])
+        if typ == 'n':
+            obj = etree.SubElement(el, 'node', id=str(osm_id), version=version, **attrs)
+            if action != 'delete':
+                obj.set('lat', f'{new["lat"]:.7f}')
+                obj.set('lon', f'{new["lon"]:.7f}')
+        else:
+            obj = etree.SubElement(el, 'way', id=str(osm_id), version=version, **attrs)
+            if action != 'delete':
+                for ref in new['refs']:
+                    etree.SubElement(obj, 'nd', ref=str(ref))
+        if action != 'delete':
+            for k, v in new['tags'].items():
+                etree.SubElement(obj, 'tag', k=k, v=v)
+    with gzip.open(filename, 'wb') as f:
+        f.write(etree.tostring(root, xml_declaration=True, encoding='utf-8'))
+
+
+def adiff_object(parent, typ, osm_id, snap, tags, i):
+    ts = (START_TS + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    attrs = {'id': str(osm_id), 'version': str(snap['version']), 'timestamp': ts,
+             'uid': str(i % 50 + 1), 'user': f'user{i % 50 + 1}', 'changeset': str(i + 2)}
+    if typ == 'n':
+        obj = etree.SubElement(parent, 'node', lat=f'{snap["lat"]:.7f}',
+                               lon=f'{snap["lon"]:.7f}', **attrs)
+    else:
+        obj = etree.SubElement(parent, 'way', **attrs)
+        refs = snap['refs']
+        coords = snap['coords']
+        etree.SubElement(
+            obj, 'bounds',
+            minlat=str(min(c[0] for c in coords)), minlon=str(min(c[1] for c in coords)),
+            maxlat=str(max(c[0] for c in coords)), maxlon=str(max(c[1] for c in coords)))
+        for ref, (lat, lon) in zip(refs, coords):
+            etree.SubElement(obj, 'nd', ref=str(ref), lat=f'{lat:.7f}', lon=f'{lon:.7f}')
+    for k, v in tags.items():
+        etree.SubElement(obj, 'tag', k=k, v=v)
+
+
+def write_adiff(dataset, changes, filename):
+    """Writes an augmented diff from snapshots of objects before and after each change."""
+    root = etree.Element('osm', version='0.6', generator='bench')
+    for i, (action, typ, osm_id, old_snap, new_snap) in enumerate(changes):
+        el = etree.SubElement(root, 'action', type=action)
+        if action == 'create':
+            adiff_object(el, typ, osm_id, new_snap, new_snap['tags'], i)
+        else:
+            old = etree.SubElement(el, 'old')
+            new = etree.SubElement(el, 'new')
+            adiff_object(old, typ, osm_id, old_snap, old_snap['tags'], i)
+            # Deleted objects keep the geometry of the last version, but lose tags
+            adiff_object(new, typ, osm_id, new_snap, new_snap['tags'], i)
+    etree.ElementTree(root).write(filename, encoding='utf-8')
+
+
+def write_regions(filename, grid):
+    """Writes a grid x grid regions CSV, with hex WKB geometries."""
+    width = (BBOX[2] - BBOX[0]) / grid
+    height = (BBOX[3] - BBOX[1]) / grid
+    with open(filename, 'w') as f:
+        for x in range(grid):
+            for y in range(grid):
+                geom = box(BBOX[0] + x * width, BBOX[1] + y * height,
+                           BBOX[0] + (x + 1) * width, BBOX[1] + (y + 1) * height)
+                f.write(f'Region {x}-{y},{geom.wkb_hex}\n')
+
+
+def generate(path, tags_file, nodes, ways, changes, relevant, grid, seed=1):
+    """Generates all files into path and returns a dict of their names, and the dataset."""
+    os.makedirs(path, exist_ok=True)
+    with open(tags_file, 'r') as f:
+        tag_filter = TagFilter(f)
+    dataset = Dataset(tag_filter, nodes, ways, relevant, seed)
+    files = {
+        'tags': tags_file,
+        'extract': os.path.join(path, 'extract.osm.pbf'),
+        'osc': os.path.join(path, 'diff.osc.gz'),
+        'adiff': os.path.join(path, 'diff.adiff'),
+        'regions': os.path.join(path, 'regions.csv'),
+    }
+    write_pbf(dataset, files['extract'])
+    write_regions(files['regions'], grid)
+    change_list = dataset.make_changes(changes)
+    write_osc(dataset, change_list, files['osc'])
+    write_adiff(dataset, change_list, files['adiff'])
+    return files, dataset
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--tags', default=os.path.join(
+        os.path.dirname(__file__), '..', 'konkurs_tags.lst'), help='Tags file')
+    parser.add_argument('--nodes', type=int, default=20000, help='Nodes in the extract')
+    parser.add_argument('--ways', type=int, default=2000, help='Ways in the extract')
+    parser.add_argument('--changes', type=int, default=5000, help='Objects in the diffs')
+    parser.add_argument('--relevant', type=float, default=0.3,
+                        help='Share of objects with watched tags')
+    parser.add_argument('--grid', type=int, default=10,
+                        help='Regions are a grid of this size squared')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic test data.')
+    parser.add_argument('path', help='Directory for generated files')
+    add_generator_arguments(parser)
+    options = parser.parse_args()
+    files, _ = generate(options.path, options.tags, options.nodes, options.ways,
+                        options.changes, options.relevant, options.grid, options.seed)
+    for k, v in files.items():
+        print(f'{k}: {v}')
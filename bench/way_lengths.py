@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Compares per-way and batched geodesic length calculation."""
+import argparse
+import os
+import random
+import sys
+import time
+from pyproj import Geod
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from adiff_to_csv import WayLengths  # noqa: E402
+
+
+def random_ways(count, max_nodes, seed=1):
+    rnd = random.Random(seed)
+    ways = []
+    for _ in range(count):
+        lon, lat = rnd.uniform(30, 60), rnd.uniform(45, 65)
+        lons, lats = [], []
+        for _ in range(rnd.randint(2, max_nodes)):
+            lon += rnd.uniform(-0.001, 0.001)
+            lat += rnd.uniform(-0.001, 0.001)
+            lons.append(round(lon, 7))
+            lats.append(round(lat, 7))
+        ways.append((lons, lats))
+    return ways
+
+
+def lengths_one_by_one(ways):
+    """What init_data_from_object used to do."""
+    result = []
+    for lons, lats in ways:
+        line = LineString(list(zip(lons, lats)))
+        geod = Geod(ellps='WGS84')
+        result.append(round(geod.geometry_length(line)))
+    return result
+
+
+def lengths_batched(ways):
+    batch = WayLengths()
+    idx = [batch.add(lons, lats) for lons, lats in ways]
+    batch.calculate()
+    return [batch[i] for i in idx]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures way length throughput for adiff_to_csv.')
+    parser.add_argument('-n', '--ways', type=int, default=20000, help='Number of ways')
+    parser.add_argument('-m', '--max-nodes', type=int, default=30, help='Max nodes in a way')
+    options = parser.parse_args()
+
+    ways = random_ways(options.ways, options.max_nodes)
+    results = {}
+    for name, func in (('per-way', lengths_one_by_one), ('batched', lengths_batched)):
+        start = time.perf_counter()
+        results[name] = func(ways)
+        elapsed = time.perf_counter() - start
+        print(f'{name:8} {elapsed:8.3f} s, {len(ways) / elapsed:10.0f} ways/s')
+    diff = sum(1 for a, b in zip(results['per-way'], results['batched']) if a != b)
+    print(f'Different lengths: {diff}')
@@ -13,7 +13,16 @@ if [ ! -d venv ]; then
 fi
 
 PYTHON=venv/bin/python
-$PYTHON lib/osc_to_adiff.py init -d "$DBNAME" -t "$TAGS" ${REGIONS+-r "$REGIONS"} "$EXTRACT"
+# With UPDATE set, only objects for new tag rules are added, and replication state is kept
+UPDATE_ARG=()
+[ -n "${UPDATE-}" ] && UPDATE_ARG=( --update )
+# With CONTESTS set, objects are watched for every contest in that file
+if [ -n "${CONTESTS-}" ]; then
+    $PYTHON osm-changes-counter init "${UPDATE_ARG[@]}" -d "$DBNAME" -c "$CONTESTS" "$EXTRACT"
+else
+    $PYTHON osm-changes-counter init "${UPDATE_ARG[@]}" -d "$DBNAME" -t "$TAGS" ${REGIONS+-r "$REGIONS"} "$EXTRACT"
+fi
+[ -n "${UPDATE-}" ] && exit 0
 
 PSQL=( psql "$DBNAME" -v ON_ERROR_STOP=1 )
 if [ -z "$INIT_SEQ" ]; then
@@ -2,10 +2,14 @@
 import argparse
 import sys
 import csv
-from filters import TagFilter, RegionFilter
+import gzip
+from filters import TagFilter, RegionFilter, read_contests
+from metrics import metrics, add_metrics_arguments, write_metrics
+from profiling import add_profiling_arguments, start_profiling
+from change_records import is_records_file, iter_record_actions
+from tracker_db import (
+    TrackerLoader, add_psql_arguments, connect, create_table_sql, create_partitions_sql)
 from lxml import etree
-from pyproj import Geod
-from shapely.geometry import LineString
 
 
 COLUMNS = [
@@ -46,7 +50,57 @@ def get_osm_id(obj):
     return f'{obj.tag}/{obj.get("id")}'
 
 
-def init_data_from_object(obj, backup=None):
+class WayLengths:
+    """
+    Collects way geometries to calculate their geodesic lengths
+    in a single pyproj call, instead of one call per way.
+    """
+    def __init__(self):
+        self.lons1 = []
+        self.lats1 = []
+        self.lons2 = []
+        self.lats2 = []
+        self.ends = []  # For each way, index after its last segment
+        self.known = {}  # index -> length, for ways with lengths known beforehand
+        self.lengths = None
+
+    def add(self, lons, lats) -> int:
+        """Adds a way and returns its index for looking up the length later."""
+        self.lons1.extend(lons[:-1])
+        self.lats1.extend(lats[:-1])
+        self.lons2.extend(lons[1:])
+        self.lats2.extend(lats[1:])
+        self.ends.append(len(self.lons1))
+        return len(self.ends) - 1
+
+    def add_known(self, length) -> int:
+        """Adds a way with an already calculated length, returns its index."""
+        self.ends.append(len(self.lons1))
+        self.known[len(self.ends) - 1] = length
+        return len(self.ends) - 1
+
+    def calculate(self):
+        self.lengths = []
+        if not self.ends:
+            return
+        dist = []
+        if self.lons1:
+            from pyproj import Geod
+            geod = Geod(ellps='WGS84')
+            _, _, dist = geod.inv(self.lons1, self.lats1, self.lons2, self.lats2)
+        start = 0
+        for end in self.ends:
+            # Summing segments one by one, like Geod.line_length does
+            self.lengths.append(round(sum(dist[start:end])))
+            start = end
+        for idx, length in self.known.items():
+            self.lengths[idx] = length
+
+    def __getitem__(self, idx):
+        return self.lengths[idx]
+
+
+def init_data_from_object(obj, backup=None, lengths=None):
     result = {
         'ts': obj.get('timestamp').replace('T', ' ').replace('Z', '+00'),
         'changeset': obj.get('changeset'),
@@ -69,67 +123,140 @@ def init_data_from_object(obj, backup=None):
             'lat': (float(bounds.get('minlat')) + float(bounds.get('maxlat'))) / 2,
         })
     if obj.tag == 'way':
+        if obj.find('nd') is None and backup is not None and backup.get('length'):
+            # A deleted way, with the length cached at its last version
+            result['length'] = lengths.add_known(int(backup.get('length')))
+            return result
         # Calculate length
         nodes = obj.findall('nd')
         if len(nodes) == 0:
             nodes = backup.findall('nd')
         if len(nodes) < 2 or not all([nd.get('lat') for nd in nodes]):
             return None
-        line = LineString([(float(nd.get('lon')), float(nd.get('lat'))) for nd in nodes])
-        geod = Geod(ellps='WGS84')
-        result['length'] = round(geod.geometry_length(line))
+        # Length is calculated later for all ways at once,
+        # so for now we store an index in the lengths batch.
+        result['length'] = lengths.add(
+            [float(nd.get('lon')) for nd in nodes],
+            [float(nd.get('lat')) for nd in nodes])
     elif obj.tag == 'relation' and len(obj.find('member')) == 0:
         return None
     return result
 
 
-def compare_kinds(tag_filter, obj, old=None):
+def get_tags(obj):
+    return {kv.get('k'): kv.get('v') for kv in obj.findall('tag')}
+
+
+def compare_kinds(tag_filter, typ, tobj, told=None):
     result = []
-    tobj = {kv.get('k'): kv.get('v') for kv in obj.findall('tag')}
-    told = {} if old is None else {kv.get('k'): kv.get('v') for kv in old.findall('tag')}
-    new_kinds = tag_filter.get_kinds(obj.tag, tobj, told)
-    old_kinds = tag_filter.get_kinds(obj.tag, told, tobj)
-    modified = tag_filter.get_modified_kinds(obj.tag, told, tobj, False)
+    if told is None:
+        told = {}
+    new_kinds = tag_filter.get_kinds(typ, tobj, told)
+    old_kinds = tag_filter.get_kinds(typ, told, tobj)
+    modified = tag_filter.get_modified_kinds(typ, told, tobj, False)
     result.extend([(k, 'create') for k in new_kinds - old_kinds])
     result.extend([(k, 'delete') for k in old_kinds - new_kinds])
     result.extend([(k, 'modify') for k in modified])
     return result
 
 
-def is_way_inside(way, another):
-    """Returns True if way's nodes are inside another's nodes."""
-    nodes = [n.get('ref') for n in way.findall('nd')]
-    anodes = [n.get('ref') for n in another.findall('nd')]
+class ModifiedWay:
+    """
+    What we need to remember about a modified way for detecting splits
+    and joins, so that the augmented diff itself can be discarded.
+    """
+    __slots__ = ('osm_id', 'old_tags', 'old_nodes', 'new_nodes')
+
+    def __init__(self, old, new):
+        self.osm_id = old.get('id')
+        self.old_tags = get_tags(old)
+        self.old_nodes = set(n.get('ref') for n in old.findall('nd'))
+        self.new_nodes = set(n.get('ref') for n in new.findall('nd'))
+
+
+class ModifiedWayIndex:
+    """Modified ways in an augmented diff, indexed by node refs of old and new versions."""
+    def __init__(self):
+        self.ways = []
+        # For old and new versions: node ref -> list of indices in self.ways
+        self.old_refs = {}
+        self.new_refs = {}
+
+    def add(self, mway):
+        idx = len(self.ways)
+        self.ways.append(mway)
+        for ref in mway.old_nodes:
+            self.old_refs.setdefault(ref, []).append(idx)
+        for ref in mway.new_nodes:
+            self.new_refs.setdefault(ref, []).append(idx)
+
+    def find(self, way_id, nodes, use_old):
+        """
+        Returns the last modified way in the diff that contains the nodes,
+        looking at its old or new version.
+        """
+        if not nodes:
+            return None
+        refs = self.old_refs if use_old else self.new_refs
+        # Both end nodes must be in the way, so start with the first one
+        for idx in reversed(refs.get(nodes[0], [])):
+            mway = self.ways[idx]
+            if mway.osm_id != way_id and is_way_inside(
+                    nodes, mway.old_nodes if use_old else mway.new_nodes):
+                return mway
+        return None
+
+
+def iter_actions(fileobj):
+    """Iterates over actions in an augmented diff, freeing each one after use."""
+    for _, action in etree.iterparse(fileobj, events=['end'], tag='action'):
+        yield action
+        action.clear()
+        # Also drop processed actions from the root element
+        while action.getprevious() is not None:
+            del action.getparent()[0]
+
+
+def get_action_reader(fileobj):
+    """Returns a function to iterate over actions in either an augmented diff or change records."""
+    return iter_record_actions if is_records_file(fileobj) else iter_actions
+
+
+def read_modified_ways(fileobj, reader=iter_actions):
+    """Returns a ModifiedWayIndex for every modified way in an augmented diff."""
+    result = ModifiedWayIndex()
+    for action in reader(fileobj):
+        if action.get('type') != 'modify':
+            continue
+        old = action.find('old')[0]
+        if old.tag == 'way':
+            result.add(ModifiedWay(old, action.find('new')[0]))
+    return result
+
+
+def is_way_inside(nodes, anodes):
+    """Returns True if way's nodes are inside another's nodes (a set)."""
     # We look for at least len(nodes) / 2 + 1 matches.
     cnt_matches = len([n for n in nodes if n in anodes])
     return nodes[0] in anodes and nodes[-1] in anodes and cnt_matches > len(nodes) / 2
 
 
-def find_way_in_another_modified(way, adiff, is_created: bool):
+def find_way_in_another_modified(way, modified_ways, is_created: bool):
     """
     So we have a created or deleted way. It may be a result of
     splitting or merging other way(s). So for created way, we look
     for its nodes inside an old version of another modified way.
     For deleted way, we look for its nodes inside a new version
     of another modified way. And we return that way back.
+    For split, we compare "old" base way with the created way.
+    For join, we compare deleted way with the "old" base way.
+    So that we can negate adding tags on base way
+    that were present on deleted way.
     """
     if way.tag != 'way':
         return None
-    candidate = None
-    version = None
-    for action in adiff.findall('action'):
-        if action.get('type') != 'modify':
-            continue
-        old_way = action.find('old' if is_created else 'new')[0]
-        if (old_way.tag == 'way' and old_way.get('id') != way.get('id') and
-                is_way_inside(way, old_way)):
-            if version is None or version < old_way.get('version'):
-                # For split, we compare "old" base way with the created way.
-                # For join, we compare deleted way with the "old" base way.
-                #   So that we can negate adding tags on base way
-                #   that were present on deleted way.
-                candidate = action.find('old')[0]
-    return candidate
+    nodes = [n.get('ref') for n in way.findall('nd')]
+    return modified_ways.find(way.get('id'), nodes, is_created)
 
 
 def write_header(output, table=None):
@@ -138,31 +265,32 @@ def write_header(output, table=None):
         output.write(col_names + '\n')
     else:
         output.write("SET client_min_messages = 'ERROR';\n")
-        output.write(f"create table if not exists {table} (\n")
-        for c in COLUMNS:
-            comma = '' if c == COLUMNS[-1] else ','
-            output.write(f"    {c[0]} {c[1]}{comma}\n")
-        output.write(");\n")
+        for sql in create_table_sql(table, COLUMNS):
+            output.write(sql + ";\n")
         # Copying into a temporary table
         output.write(f"drop table if exists tmp_{table};\n")
-        output.write(f"create table tmp_{table} (like {table} including defaults);\n")
+        # Only data columns, so that row_id values are taken when inserting into the table
+        col_defs = ', '.join(f'{c[0]} {c[1]}' for c in COLUMNS)
+        output.write(f"create table tmp_{table} ({col_defs});\n")
         output.write(f"copy tmp_{table} ({col_names}) from stdin (format csv);\n")
 
 
 def write_footer(output, table=None):
     if table:
         output.write("\\.\n\n")
-        output.write(f"insert into {table} select * from tmp_{table} "
+        output.write(create_partitions_sql(table, f'tmp_{table}') + ";\n")
+        col_names = ','.join(c[0] for c in COLUMNS)
+        output.write(f"insert into {table} ({col_names}) select {col_names} from tmp_{table} "
                      "on conflict do nothing;\n")
         output.write(f"drop table tmp_{table};\n")
-        output.write(f"create unique index if not exists idx_{table} on {table} "
-                     "(osm_id, version, kind);\n")
 
 
-def process_single_action(action, adiff, regions=None, tag_filter=None):
+def process_single_action(action, modified_ways, filters, lengths=None):
     """
     Processes a single action in an augmented diff.
-    Returns a list of rows to print.
+    Receives a list of (regions, tag_filter) and yields (filter index, row)
+    for every row to print. For ways, "length" is an index
+    in the lengths batch, to be replaced after WayLengths.calculate().
     """
     atype = action.get('type')
     obj = action[0] if atype == 'create' else action.find('new')[0]
@@ -170,45 +298,105 @@ def process_single_action(action, adiff, regions=None, tag_filter=None):
         # We do not process relations.
         return
     old = None if atype == 'create' else action.find('old')[0]
-    data = init_data_from_object(obj, old)
+    data = init_data_from_object(obj, old, lengths)
     if not data:
         return
-    if regions and not regions.is_empty:
-        data['region'] = regions.find(data['lon'], data['lat'])
-        if not data['region']:
-            return
+    # Regions are looked up once for each filter; the object is dropped
+    # when it is outside of every set of regions.
+    found_regions = []
+    for regions, _ in filters:
+        if regions and not regions.is_empty:
+            found_regions.append(regions.find(data['lon'], data['lat']))
+        else:
+            found_regions.append(True)
+    if not any(found_regions):
+        return
     # Note that for deleted objects "obj" has all its data,
     # and "old" has just some of the header values.
-    ancestor = None
+    tags = get_tags(obj)
+    old_tags = None if old is None else get_tags(old)
     if obj.tag == 'way':
         if atype == 'create':
-            ancestor = find_way_in_another_modified(obj, adiff, True)
+            ancestor = find_way_in_another_modified(obj, modified_ways, True)
             if ancestor is not None:
                 # Some way was split into this (and possibly others).
                 atype = 'split'
-                data['prev_id'] = get_osm_id(ancestor)
-                old = ancestor  # just for comparing tags
+                data['prev_id'] = f'way/{ancestor.osm_id}'
+                old_tags = ancestor.old_tags  # just for comparing tags
         elif atype == 'delete':
-            ancestor = find_way_in_another_modified(old, adiff, False)
+            ancestor = find_way_in_another_modified(old, modified_ways, False)
             if ancestor is not None:
                 # This way (and possibly others) were merged into the ancestor.
                 atype = 'join'
-                data['prev_id'] = get_osm_id(ancestor)
-                obj = ancestor  # just for comparing tags
+                data['prev_id'] = f'way/{ancestor.osm_id}'
+                tags = ancestor.old_tags  # just for comparing tags
     data['obj_action'] = atype
     # Find tagging differences and write them out.
-    kinds = compare_kinds(tag_filter, obj, old)
-    for k in kinds:
-        data['action'] = k[1]
-        data['kind'] = k[0]
-        yield data
+    for i, (_, tag_filter) in enumerate(filters):
+        region = found_regions[i]
+        if not region:
+            continue
+        if region is not True:
+            data['region'] = region
+        else:
+            data.pop('region', None)
+        kinds = compare_kinds(tag_filter, obj.tag, tags, old_tags)
+        for k in kinds:
+            data['action'] = k[1]
+            data['kind'] = k[0]
+            yield i, dict(data)
 
 
-if __name__ == '__main__':
+def process_adiff_multi(fileobj, filters):
+    """
+    Reads an augmented diff once and returns a list of rows
+    for each of (regions, tag_filter) in filters.
+    """
+    reader = get_action_reader(fileobj)
+    # Find modified ways for detecting splits and joins.
+    with metrics.stage('modified_ways'):
+        modified_ways = read_modified_ways(fileobj, reader)
+        fileobj.seek(0)
+    metrics.count('modified_ways', len(modified_ways.ways))
+
+    # Iterate over every action (each of which has just one object).
+    lengths = WayLengths()
+    results = [[] for _ in filters]
+    with metrics.stage('actions'):
+        for action in reader(fileobj):
+            metrics.count('actions')
+            for i, row in process_single_action(action, modified_ways, filters, lengths):
+                results[i].append(row)
+    with metrics.stage('lengths'):
+        lengths.calculate()
+    metrics.count('ways_measured', len(lengths.ends))
+    for rows in results:
+        for row in rows:
+            if row.get('length') is not None:
+                row['length'] = lengths[row['length']]
+        metrics.count('rows', len(rows))
+    return results
+
+
+def process_adiff(fileobj, regions=None, tag_filter=None):
+    """Reads an augmented diff and returns a list of rows for the tracker table."""
+    return process_adiff_multi(fileobj, [(regions, tag_filter)])[0]
+
+
+def write_rows(output, rows, table=None):
+    writer = csv.DictWriter(output, [c[0] for c in COLUMNS])
+    write_header(output, table)
+    for row in rows:
+        writer.writerow(row)
+    write_footer(output, table)
+
+
+def main(argv=None, prog=None):
     parser = argparse.ArgumentParser(
+        prog=prog,
         description='Extracts road changes from an augmented diff file.')
     parser.add_argument('adiff', type=argparse.FileType('rb'),
-                        help='Augmented diff file')
+                        help='Augmented diff or change records file')
     parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
                         help='Output CSV or SQL file')
     parser.add_argument('-t', '--tags', type=argparse.FileType('r'),
@@ -216,24 +404,49 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--regions', type=argparse.FileType('r'),
                         help='CSV file with names and wkb geometry for regions to filter')
     parser.add_argument('-p', '--table',
-                        help='Instead of CSV, print SQL for importing into this psql table')
-    options = parser.parse_args()
+                        help='Instead of CSV, print SQL for importing into this psql table, '
+                        'or load into it with --database')
+    parser.add_argument('-c', '--contests', type=argparse.FileType('r'),
+                        help='File with contests (name, table, tags, regions) '
+                        'to evaluate in a single pass, replaces -t, -r and -p')
+    add_metrics_arguments(parser)
+    add_profiling_arguments(parser)
+    add_psql_arguments(parser)
+    options = parser.parse_args(argv)
+    if options.database and not options.table and not options.contests:
+        parser.error('Please specify a table name for loading into the database')
+    profiler = start_profiling(options)
+    try:
+        if options.adiff.name.endswith('.gz'):
+            options.adiff = gzip.GzipFile(fileobj=options.adiff)
 
-    # Read regions and the augmented diff.
-    tags = TagFilter(options.tags)
-    regions = RegionFilter(options.regions)
-    adiff = etree.parse(options.adiff).getroot()
+        if options.contests:
+            contests = read_contests(options.contests)
+            tables = [c.table for c in contests]
+            results = process_adiff_multi(
+                options.adiff, [(c.regions, c.tags) for c in contests])
+        else:
+            tables = [options.table]
+            results = [process_adiff(
+                options.adiff, RegionFilter(options.regions), TagFilter(options.tags))]
 
-    # Prepare writer and write the header.
-    writer = csv.DictWriter(options.output, [c[0] for c in COLUMNS])
-    wrote_header = False
+        if options.database:
+            # Load rows straight into the database
+            with metrics.stage('load'):
+                conn = connect(options)
+                for table, rows in zip(tables, results):
+                    metrics.count('rows_added', TrackerLoader(conn, table, COLUMNS).load(rows))
+                conn.close()
+        else:
+            # Prepare writer and write the rows.
+            with metrics.stage('write'):
+                for table, rows in zip(tables, results):
+                    if rows:
+                        write_rows(options.output, rows, table)
+    finally:
+        profiler.stop()
+    write_metrics(options, 'adiff_to_csv', input=options.adiff.name)
 
-    # Iterate over every action (each of which has just one object).
-    for action in adiff.findall('action'):
-        for row in process_single_action(action, adiff, regions, tags):
-            if not wrote_header:
-                write_header(options.output, options.table)
-                wrote_header = True
-            writer.writerow(row)
-    if wrote_header:
-        write_footer(options.output, options.table)
+
+if __name__ == '__main__':
+    main()
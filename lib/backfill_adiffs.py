@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import glob
+import gzip
+import logging
+import os
+import sys
+import time
+from multiprocessing import Pool
+from filters import TagFilter, RegionFilter
+from adiff_to_csv import COLUMNS, process_adiff, write_header, write_footer
+from tracker_db import TrackerLoader, add_psql_arguments, connect
+
+
+# Filters for a worker process, loaded once in init_worker
+worker_filters = {}
+
+
+def init_worker(tags_file, regions_file):
+    worker_filters['tags'] = TagFilter(None if not tags_file else open(tags_file, 'r'))
+    worker_filters['regions'] = RegionFilter(
+        None if not regions_file else open(regions_file, 'r'))
+
+
+def process_file(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        rows = process_adiff(f, worker_filters['regions'], worker_filters['tags'])
+    return filename, os.path.getsize(filename), rows
+
+
+def sort_key(filename):
+    """Sorts "123.adiff", "123.adiff.gz" and "123.chr" files by numeric ids, others by name."""
+    name = os.path.basename(filename).split('.')[0]
+    return (0, int(name), '') if name.isdigit() else (1, 0, filename)
+
+
+def list_files(sources):
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files.extend(glob.glob(os.path.join(source, '*.adiff')))
+            files.extend(glob.glob(os.path.join(source, '*.adiff.gz')))
+            files.extend(glob.glob(os.path.join(source, '*.chr')))
+        else:
+            files.extend(glob.glob(source))
+    return sorted(set(files), key=sort_key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Processes many augmented diff files in parallel into one output.')
+    parser.add_argument('adiff', nargs='+',
+                        help='Directories with *.adiff, *.adiff.gz or *.chr files, '
+                        'or files, or glob masks')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help='Output CSV or SQL file')
+    parser.add_argument('-t', '--tags', help='File with a list of tags to watch')
+    parser.add_argument('-r', '--regions',
+                        help='CSV file with names and wkb geometry for regions to filter')
+    parser.add_argument('-p', '--table',
+                        help='Instead of CSV, print SQL for importing into this psql table, '
+                        'or load into it with --database')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of worker processes, default is the number of CPUs')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print progress for every file')
+    add_psql_arguments(parser)
+    options = parser.parse_args()
+    if options.database and not options.table:
+        parser.error('Please specify a table name for loading into the database')
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING,
+                        format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+
+    files = list_files(options.adiff)
+    if not files:
+        logging.error('No augmented diff files found')
+        sys.exit(1)
+
+    if options.database:
+        conn = connect(options)
+        loader = TrackerLoader(conn, options.table, COLUMNS)
+    else:
+        loader = None
+        writer = csv.DictWriter(options.output, [c[0] for c in COLUMNS])
+        write_header(options.output, options.table)
+    start = time.perf_counter()
+    total_rows = 0
+    total_bytes = 0
+    with Pool(options.jobs, init_worker, (options.tags, options.regions)) as pool:
+        # imap keeps the order of files, so rows go out in the order of diffs
+        for i, (filename, size, rows) in enumerate(pool.imap(process_file, files), 1):
+            if loader:
+                loader.load(rows)
+            else:
+                for row in rows:
+                    writer.writerow(row)
+            total_rows += len(rows)
+            total_bytes += size
+            elapsed = time.perf_counter() - start
+            logging.info('%s/%s %s: %s rows, %.1f files/s, %.1f MB/s',
+                         i, len(files), filename, len(rows),
+                         i / elapsed, total_bytes / 1024 / 1024 / elapsed)
+    if loader:
+        conn.close()
+    else:
+        write_footer(options.output, options.table)
+    elapsed = time.perf_counter() - start
+    sys.stderr.write(f'Processed {len(files)} files with {total_rows} rows '
+                     f'in {elapsed:.1f} s ({len(files) / elapsed:.1f} files/s).\n')
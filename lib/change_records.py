@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Compact binary storage for augmented diff actions.
+
+A change records file is gzipped, and consists of records, each prefixed
+with its length as a 4-byte little-endian integer. Every record is msgpack.
+The first record is a header, and each of the others is one action:
+
+    [type, old, new]
+
+where "old" is None for created objects, and an object is
+
+    [tag, attributes, tags, nodes, members, bounds]
+
+with nodes as [ref, lat, lon], members as [type, ref, role, lat, lon],
+and bounds as [minlat, minlon, maxlat, maxlon] or None.
+"""
+import argparse
+import gzip
+import struct
+import sys
+from lxml import etree
+
+
+FORMAT = 'osm-change-records'
+VERSION = 1
+GZIP_MAGIC = b'\x1f\x8b'
+LENGTH = struct.Struct('<I')
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def element_to_object(obj):
+    tags = {}
+    nodes = []
+    members = []
+    bounds = None
+    for child in obj:
+        if child.tag == 'tag':
+            tags[child.get('k')] = child.get('v')
+        elif child.tag == 'nd':
+            nodes.append([child.get('ref'), _float(child.get('lat')), _float(child.get('lon'))])
+        elif child.tag == 'member':
+            members.append([child.get('type'), child.get('ref'), child.get('role'),
+                            _float(child.get('lat')), _float(child.get('lon'))])
+        elif child.tag == 'bounds':
+            bounds = [float(child.get(k)) for k in ('minlat', 'minlon', 'maxlat', 'maxlon')]
+    return [obj.tag, dict(obj.attrib), tags, nodes, members, bounds]
+
+
+def object_to_element(parent, record):
+    tag, attrs, tags, nodes, members, bounds = record
+    obj = etree.SubElement(parent, tag, attrs)
+    for k, v in tags.items():
+        etree.SubElement(obj, 'tag', k=k, v=v)
+    for ref, lat, lon in nodes:
+        nd = etree.SubElement(obj, 'nd', ref=ref)
+        if lat is not None:
+            nd.set('lat', str(lat))
+            nd.set('lon', str(lon))
+    for typ, ref, role, lat, lon in members:
+        member = etree.SubElement(obj, 'member', type=typ, ref=ref, role=role)
+        if lat is not None:
+            member.set('lat', str(lat))
+            member.set('lon', str(lon))
+    if bounds:
+        etree.SubElement(obj, 'bounds', dict(zip(
+            ('minlat', 'minlon', 'maxlat', 'maxlon'), (_str(b) for b in bounds))))
+    return obj
+
+
+def action_to_record(action):
+    atype = action.get('type')
+    if atype == 'create':
+        return [atype, None, element_to_object(action[0])]
+    old = action.find('old')
+    new = action.find('new')
+    return [
+        atype,
+        None if old is None or len(old) == 0 else element_to_object(old[0]),
+        element_to_object(new[0]),
+    ]
+
+
+def record_to_action(record):
+    atype, old, new = record
+    action = etree.Element('action', type=atype)
+    if atype == 'create':
+        object_to_element(action, new)
+    else:
+        na_old = etree.SubElement(action, 'old')
+        if old:
+            object_to_element(na_old, old)
+        object_to_element(etree.SubElement(action, 'new'), new)
+    return action
+
+
+class RecordWriter:
+    def __init__(self, fileobj):
+        import msgpack
+        self.packer = msgpack.Packer()
+        self.out = gzip.GzipFile(fileobj=fileobj, mode='wb')
+        self.count = 0
+        self._write({'format': FORMAT, 'version': VERSION})
+
+    def _write(self, record):
+        data = self.packer.pack(record)
+        self.out.write(LENGTH.pack(len(data)))
+        self.out.write(data)
+
+    def write_action(self, action):
+        """Writes an augmented diff action element."""
+        self._write(action_to_record(action))
+        self.count += 1
+
+    def close(self):
+        """Finishes the gzip stream, but leaves the file open."""
+        self.out.close()
+
+
+def is_records_file(fileobj) -> bool:
+    """Checks whether a seekable file is a change records file and not an XML."""
+    magic = fileobj.read(2)
+    fileobj.seek(0)
+    return magic == GZIP_MAGIC
+
+
+def iter_records(fileobj):
+    """Iterates over action records in a file, after checking the header."""
+    import msgpack
+    src = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    header = None
+    while True:
+        prefix = src.read(LENGTH.size)
+        if not prefix:
+            break
+        data = src.read(LENGTH.unpack(prefix)[0])
+        record = msgpack.unpackb(data, use_list=True)
+        if header is None:
+            header = record
+            if not isinstance(header, dict) or header.get('format') != FORMAT:
+                raise ValueError('Not a change records file')
+            if header.get('version', 0) > VERSION:
+                raise ValueError(f'Unsupported change records version {header["version"]}')
+            continue
+        yield record
+
+
+def iter_record_actions(fileobj):
+    """Like adiff_to_csv.iter_actions, but for a change records file."""
+    for record in iter_records(fileobj):
+        yield record_to_action(record)
+
+
+def adiff_to_records(adiff, output) -> int:
+    """Converts an augmented diff XML into change records, returns the number of actions."""
+    from adiff_to_csv import iter_actions
+    writer = RecordWriter(output)
+    for action in iter_actions(adiff):
+        writer.write_action(action)
+    writer.close()
+    return writer.count
+
+
+def records_to_adiff(records, output) -> int:
+    """Converts change records into an augmented diff XML, returns the number of actions."""
+    count = 0
+    with etree.xmlfile(output, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('osm', version='0.6', generator='OSC to ADIFF'):
+            for action in iter_record_actions(records):
+                xf.write(action, pretty_print=True)
+                count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Converts augmented diffs to compact change records and back.')
+    parser.add_argument('input', type=argparse.FileType('rb'),
+                        help='Augmented diff or change records file')
+    parser.add_argument('output', type=argparse.FileType('wb'),
+                        help='Resulting file, in the other format')
+    options = parser.parse_args()
+
+    if is_records_file(options.input):
+        count = records_to_adiff(options.input, options.output)
+    else:
+        count = adiff_to_records(options.input, options.output)
+    sys.stderr.write(f'Converted {count} actions\n')
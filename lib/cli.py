@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+A single entry point for all the scripts. Each command imports only its own module,
+so e.g. calculating statistics does not load osmium, shapely or pyproj.
+"""
+import importlib
+import sys
+
+
+COMMANDS = {
+    # name: (module, extra keyword arguments for main(), description)
+    'init': ('osc_to_adiff', {'action': 'init'}, 'Load watched objects from an extract'),
+    'process': ('osc_to_adiff', {'action': 'process'},
+                'Convert an osmChange file into an augmented diff'),
+    'extract': ('adiff_to_csv', {}, 'Extract changes from an augmented diff into a tracker table'),
+    'fetch': ('fetch_adiffs', {}, 'Download augmented diffs from Overpass and extract changes'),
+    'stats': ('generate_user_stats', {}, 'Calculate user statistics'),
+    'serve': ('stats_server', {}, 'Serve the leaderboard over HTTP'),
+    'uids': ('form_to_uid', {}, 'Find uids for users from a registration form'),
+}
+
+
+def print_usage(prog, out):
+    out.write(f'Usage: {prog} <command> [<args>]\n\nCommands:\n')
+    for name, (_, _, description) in COMMANDS.items():
+        out.write(f'  {name:10} {description}\n')
+    out.write(f'\nRun "{prog} <command> --help" for command arguments.\n')
+
+
+def main(argv=None, prog='osm-changes-counter'):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] in ('-h', '--help'):
+        print_usage(prog, sys.stdout)
+        sys.exit(0)
+    if argv[0] not in COMMANDS:
+        sys.stderr.write(f'Unknown command: {argv[0]}\n\n')
+        print_usage(prog, sys.stderr)
+        sys.exit(2)
+    module_name, kwargs, _ = COMMANDS[argv[0]]
+    module = importlib.import_module(module_name)
+    module.main(argv[1:], f'{prog} {argv[0]}', **kwargs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Downloads Overpass augmented diffs starting from the last processed id,
+prefetching a few upcoming ids at once, and loads changes into a tracker table.
+"""
+import argparse
+import gzip
+import io
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+from adiff_to_csv import COLUMNS, process_adiff_multi
+from filters import TagFilter, RegionFilter, read_contests
+from gen_adiff_timestamps import current_adiff_id, adiff_id_to_time
+from metrics import metrics, add_metrics_arguments, write_metrics
+from tracker_db import TrackerLoader, add_psql_arguments, connect
+
+
+OVERPASS = 'https://overpass-api.de/api'
+ACTION_TYPES = {'create', 'modify', 'delete'}
+
+
+def validate_adiff(content):
+    """Returns None if the augmented diff looks complete, or a reason otherwise."""
+    try:
+        root = etree.fromstring(content)
+    except etree.XMLSyntaxError as e:
+        return f'broken XML: {e}'
+    if root.tag != 'osm':
+        return f'root element is {root.tag}'
+    actions = root.findall('action')
+    if not actions:
+        # Overpass returns an empty document for diffs it does not have yet
+        return 'no actions'
+    for action in actions:
+        atype = action.get('type')
+        if atype not in ACTION_TYPES:
+            return f'wrong action type {atype}'
+        if atype != 'create' and (action.find('old') is None or action.find('new') is None):
+            return f'no old or new in a {atype} action'
+    return None
+
+
+class AdiffFetcher:
+    def __init__(self, url=OVERPASS, min_delay=5, max_delay=300):
+        import requests
+        self.url = url
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        # Set to make fetch() in every thread give up
+        self.stop = threading.Event()
+        self.turn_lock = threading.Lock()
+        self.next_request = 0
+
+    def wait_until_available(self, adiff_id):
+        while adiff_id >= current_adiff_id() and not self.stop.is_set():
+            self.stop.wait(self.min_delay)
+
+    def wait_turn(self):
+        """Keeps at least min_delay between requests from all threads."""
+        with self.turn_lock:
+            self.stop.wait(self.next_request - time.monotonic())
+            self.next_request = time.monotonic() + self.min_delay
+
+    def fetch(self, adiff_id):
+        """Downloads a valid augmented diff, retrying until it succeeds or is stopped."""
+        import requests
+        delay = self.min_delay
+        while not self.stop.is_set():
+            self.wait_until_available(adiff_id)
+            self.wait_turn()
+            if self.stop.is_set():
+                break
+            retry_after = None
+            try:
+                resp = self.session.get(f'{self.url}/augmented_diff',
+                                        params={'id': adiff_id}, timeout=300)
+                metrics.count('fetch_requests')
+                if resp.status_code == 200:
+                    metrics.count('fetch_bytes', len(resp.content))
+                    reason = validate_adiff(resp.content)
+                    if not reason:
+                        return resp.content
+                else:
+                    reason = f'HTTP {resp.status_code}'
+                    retry_after = resp.headers.get('Retry-After')
+            except requests.RequestException as e:
+                reason = str(e)
+            metrics.count('fetch_retries')
+            if retry_after and retry_after.isdigit():
+                # The server knows better when to come back
+                delay = max(self.min_delay, int(retry_after))
+            logging.info('Augmented diff %s: %s, retrying in %s s', adiff_id, reason, delay)
+            self.stop.wait(delay)
+            delay = min(delay * 2, self.max_delay)
+        return None
+
+
+def prefetch(ids, fetch, window, stop=None):
+    """
+    Yields (id, result of fetch) in order, keeping up to window downloads running.
+    When the consumer stops or fails, sets the stop event for running downloads.
+    """
+    ids = iter(ids)
+    pool = ThreadPoolExecutor(window)
+    try:
+        pending = deque((i, pool.submit(fetch, i)) for i in itertools.islice(ids, window))
+        while pending:
+            adiff_id, future = pending.popleft()
+            content = future.result()
+            for next_id in itertools.islice(ids, 1):
+                pending.append((next_id, pool.submit(fetch, next_id)))
+            yield adiff_id, content
+    finally:
+        # Downloads that are still retrying check the stop event
+        if stop is not None:
+            stop.set()
+        pool.shutdown(cancel_futures=True)
+
+
+def read_last_id(conn, ts_table):
+    with conn.cursor() as cur:
+        cur.execute(f"select ts from {ts_table} order by ts desc limit 1")
+        row = cur.fetchone()
+    return None if not row else row[0]
+
+
+def save_last_id(conn, ts_table, adiff_id):
+    with conn.cursor() as cur:
+        cur.execute(f"insert into {ts_table} (ts) values (%s)", (adiff_id,))
+        cur.execute(f"delete from {ts_table} where ts < %s", (adiff_id,))
+    conn.commit()
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Downloads augmented diffs from Overpass API and loads changes '
+        'into a tracker table.')
+    parser.add_argument('-t', '--tags', type=argparse.FileType('r'),
+                        help='File with a list of tags to watch')
+    parser.add_argument('-r', '--regions', type=argparse.FileType('r'),
+                        help='CSV file with names and wkb geometry for regions to filter')
+    parser.add_argument('-c', '--contests', type=argparse.FileType('r'),
+                        help='File with contests (name, table, tags, regions), '
+                        'replaces -t, -r and -p')
+    parser.add_argument('-p', '--table', default='adiff_tracker',
+                        help='Tracker table, default is adiff_tracker')
+    parser.add_argument('--ts-table', default='adiff_tracker_ts',
+                        help='Table with the last processed id, default is adiff_tracker_ts')
+    parser.add_argument('--from', dest='from_id', type=int,
+                        help='First id to download, default is after the last processed')
+    parser.add_argument('--to', dest='to_id', type=int,
+                        help='Last id to download, default is the latest available')
+    parser.add_argument('--url', default=OVERPASS, help=f'Overpass API URL, default {OVERPASS}')
+    parser.add_argument('-w', '--window', type=int, default=2,
+                        help='Number of diffs to download at once, default is 2. Public '
+                        'Overpass instances allow only a few requests at once per IP')
+    parser.add_argument('--delay', type=float, default=2,
+                        help='Seconds between requests, and the first retry delay, '
+                        'default is 2')
+    parser.add_argument('--store', help='Keep gzipped augmented diffs in this directory')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print progress for every diff')
+    add_metrics_arguments(parser)
+    add_psql_arguments(parser, required=True)
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING,
+                        format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+    if options.contests:
+        contests = read_contests(options.contests)
+        tables = [c.table for c in contests]
+        filters = [(c.regions, c.tags) for c in contests]
+    else:
+        tables = [options.table]
+        filters = [(RegionFilter(options.regions), TagFilter(options.tags))]
+
+    conn = connect(options)
+    from_id = options.from_id
+    if from_id is None:
+        last_id = read_last_id(conn, options.ts_table)
+        if last_id is None:
+            parser.error(f'No ids in {options.ts_table}, please specify --from')
+        from_id = last_id + 1
+    to_id = options.to_id or current_adiff_id() - 1
+    if options.store:
+        os.makedirs(options.store, exist_ok=True)
+
+    loaders = [TrackerLoader(conn, table, COLUMNS) for table in tables]
+    fetcher = AdiffFetcher(options.url, options.delay)
+    for adiff_id, content in prefetch(range(from_id, to_id + 1), fetcher.fetch,
+                                      options.window, fetcher.stop):
+        if options.store:
+            with open(os.path.join(options.store, f'{adiff_id}.adiff.gz'), 'wb') as f:
+                f.write(gzip.compress(content))
+        with metrics.stage('process'):
+            results = process_adiff_multi(io.BytesIO(content), filters)
+        with metrics.stage('load'):
+            for loader, rows in zip(loaders, results):
+                metrics.count('rows_added', loader.load(rows))
+        save_last_id(conn, options.ts_table, adiff_id)
+        metrics.count('adiffs')
+        logging.info('%s (%s): %s rows', adiff_id,
+                     adiff_id_to_time(adiff_id).strftime('%Y-%m-%d %H:%M'),
+                     sum(len(rows) for rows in results))
+    conn.close()
+    write_metrics(options, 'fetch_adiffs', from_id=from_id, to_id=to_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,5 @@
 import csv
-from shapely import wkb
-from shapely.geometry import Point
-from shapely.strtree import STRtree
+from metrics import metrics
 
 
 class TagFilter:
@@ -22,10 +20,23 @@ class TagFilter:
                 continue
             parts = [k.lower() for k in line.split()]
             if len(parts) > 1:
-                kind = parts[1].split('+')[0]
-                tag = parts[-1].split('+')[0]
-                self.kinds[parts[0][0]][tag] = kind
-                self.relevant_keys.add(tag.split('=')[0])
+                self.add_rule(parts[0][0], parts[-1].split('+')[0], parts[1].split('+')[0])
+
+    def add_rule(self, typ, tag, kind):
+        self.kinds[typ][tag] = kind
+        self.relevant_keys.add(tag.split('=')[0])
+
+    def rules(self) -> set:
+        """Returns a set of (type letter, tag, kind), e.g. for storing in the database."""
+        return {(typ, tag, kind) for typ, kinds in self.kinds.items()
+                for tag, kind in kinds.items()}
+
+    @staticmethod
+    def from_rules(rules):
+        tag_filter = TagFilter(None)
+        for rule in rules:
+            tag_filter.add_rule(*rule)
+        return tag_filter
 
     def check_context(self, ctx, tags1, tags2=None, strong_ctx=True) -> bool:
         if not ctx:
@@ -128,6 +139,7 @@ class TagFilter:
 class RegionFilter:
     def __init__(self, fileobj=None):
         self.tree = None
+        self.regions = []
         self.region_map = {}
         if fileobj:
             self.load(fileobj)
@@ -137,17 +149,70 @@ class RegionFilter:
         return self.tree is None or len(self.region_map) == 0
 
     def load(self, fileobj):
+        from shapely import wkb
         regions = []
         csv.field_size_limit(1000000)
         for row in csv.reader(fileobj):
             regions.append((row[0], wkb.loads(bytes.fromhex(row[1]))))
+        self.set_regions(regions)
+
+    def set_regions(self, regions):
+        """Receives a list of (name, geometry)."""
+        from shapely.strtree import STRtree
+        self.regions = regions
         self.tree = STRtree([r[1] for r in regions])
         self.region_map = {id(r[1]): r[0] for r in regions}
 
     def find(self, lon, lat):
         if self.is_empty:
             return None
+        from shapely.geometry import Point
         pt = Point(lon, lat)
         results = self.tree.query(pt)
         results = [r for r in results if r.contains(pt)]
+        metrics.count('region_filter_inside' if results else 'region_filter_outside')
         return None if not results else self.region_map[id(results[0])]
+
+
+class Contest:
+    """A named set of filters, with a tracker table for its results."""
+    def __init__(self, name, table, tags_file, regions_file=None):
+        self.name = name
+        self.table = table
+        with open(tags_file, 'r') as f:
+            self.tags = TagFilter(f)
+        self.regions = RegionFilter()
+        if regions_file:
+            with open(regions_file, 'r') as f:
+                self.regions.load(f)
+
+
+def read_contests(fileobj):
+    """
+    Reads a file with a contest on each line:
+    name, tracker table, tags file and an optional regions file.
+    """
+    contests = []
+    for row in fileobj:
+        line = row.strip()
+        if not line or line[0] == '#':
+            continue
+        parts = line.split()
+        if len(parts) < 3:
+            raise ValueError(f'Expecting name, table and tags file in "{line}"')
+        contests.append(Contest(*parts[:4]))
+    return contests
+
+
+def union_filters(contests):
+    """Returns a TagFilter and a RegionFilter that pass everything any contest needs."""
+    tags = TagFilter(None)
+    if all(not c.tags.is_empty for c in contests):
+        for c in contests:
+            tags.relevant_keys.update(c.tags.relevant_keys)
+            for typ, kinds in c.tags.kinds.items():
+                tags.kinds[typ].update(kinds)
+    regions = RegionFilter()
+    if all(not c.regions.is_empty for c in contests):
+        regions.set_regions([r for c in contests for r in c.regions.regions])
+    return tags, regions
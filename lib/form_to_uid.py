@@ -1,20 +1,63 @@
 #!/usr/bin/env python3
+import argparse
 import sys
 import os
 import csv
+import json
+import time
 import requests
 import urllib.parse as up
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 
 
+API = 'https://api.openstreetmap.org/api/0.6'
+# How many uids to ask for in one /users request
+CHUNK_SIZE = 100
+
+
+class UserCache:
+    """
+    Keeps uids for display names and account metadata for uids in a JSON file,
+    so that repeated runs do not query the same users again until the ttl passes.
+    """
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self.data = {'names': {}, 'users': {}}
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.data.update(json.load(f))
+
+    def has(self, section, key) -> bool:
+        """Missing users are not remembered, for they might register or be found later."""
+        entry = self.data[section].get(key)
+        return (entry is not None and entry['value'] is not None and
+                time.time() - entry['ts'] < self.ttl)
+
+    def get(self, section, key):
+        entry = self.data[section].get(key)
+        return None if not entry else entry['value']
+
+    def set(self, section, key, value):
+        self.data[section][key] = {'value': value, 'ts': time.time()}
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp_name = self.filename + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_name, self.filename)
+
+
 def find_uid(username):
-    resp = requests.get(
-        'https://api.openstreetmap.org/api/0.6/changesets',
-        {'display_name': username}
-    )
-    if resp.status_code != 200:
+    """Returns None if there is no such user, raises RequestException on other errors."""
+    resp = requests.get(f'{API}/changesets', {'display_name': username})
+    if resp.status_code == 404:
         sys.stderr.write(f'User display name is wrong: {username}\n')
         return None
+    resp.raise_for_status()
     root = etree.fromstring(resp.content)
     changeset = root.find('changeset')
     if changeset is None:
@@ -23,30 +66,78 @@ def find_uid(username):
     return changeset.get('uid')
 
 
-def find_class(uid):
-    resp = requests.get(f'https://api.openstreetmap.org/api/0.6/user/{uid}')
-    if resp.status_code != 200:
-        return None
-    user = etree.fromstring(resp.content)[0]
-    created = user.get('account_created')
+def parse_user(user):
     ch = user.find('changesets')
-    changesets = None if ch is None else int(ch.get('count'))
-    if changesets >= 100 and created <= '2020-09-10':
+    return {
+        'created': user.get('account_created'),
+        'changesets': None if ch is None else int(ch.get('count')),
+    }
+
+
+def find_user(uid):
+    """Returns None for missing or suspended users, raises RequestException on other errors."""
+    resp = requests.get(f'{API}/user/{uid}')
+    if resp.status_code in (404, 410):
+        return None
+    resp.raise_for_status()
+    return parse_user(etree.fromstring(resp.content)[0])
+
+
+def find_users(uids):
+    """
+    Returns a dict of uid -> account metadata, or None for users that do not exist,
+    querying users in chunks. Uids that could not be queried are left out.
+    """
+    uids = list(uids)
+    result = {}
+    for i in range(0, len(uids), CHUNK_SIZE):
+        chunk = uids[i:i + CHUNK_SIZE]
+        try:
+            resp = requests.get(f'{API}/users', {'users': ','.join(chunk)})
+        except requests.RequestException:
+            resp = None
+        if resp is not None and resp.status_code == 200:
+            for user in etree.fromstring(resp.content).findall('user'):
+                result[user.get('id')] = parse_user(user)
+        else:
+            # Some users in the chunk are missing or suspended, asking one by one
+            for uid in chunk:
+                try:
+                    result[uid] = find_user(uid)
+                except requests.RequestException as e:
+                    sys.stderr.write(f'Could not query user {uid}: {e}\n')
+        sys.stderr.write('.')
+        sys.stderr.flush()
+    return result
+
+
+def find_class(meta):
+    if not meta or meta['changesets'] is None:
+        return None
+    if meta['changesets'] >= 100 and meta['created'] <= '2020-09-10':
         return 1
     return 2
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('Reads the google docs user form and finds uid for each user.')
-        print('Usage: {0} <gdocs_form.csv> <output.csv>')
-        sys.exit(1)
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Reads the google docs user form and finds uid for each user.')
+    parser.add_argument('form', help='CSV file with the form responses')
+    parser.add_argument('output', help='CSV file with users and uids, is updated if exists')
+    parser.add_argument('--cache', help='JSON file for caching OSM API responses, '
+                        'default is the output name with ".cache.json"')
+    parser.add_argument('--ttl', type=float, default=7,
+                        help='Days to keep cached responses, default is 7')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Number of display names to look up at once, default is 8')
+    options = parser.parse_args(argv)
 
     uids = {}  # login -> uid
     usernames = {}  # name -> login
     classes = {}  # uid -> class
-    if os.path.exists(sys.argv[2]):
-        with open(sys.argv[2], 'r') as f:
+    if os.path.exists(options.output):
+        with open(options.output, 'r') as f:
             for row in csv.reader(f):
                 if row[0].strip():
                     usernames[row[0]] = row[1]
@@ -56,7 +147,7 @@ if __name__ == '__main__':
                         classes[row[2]] = row[3]
 
     predef_usernames = set([k for k in usernames.keys() if uids.get(usernames[k])])
-    with open(sys.argv[1], 'r') as f:
+    with open(options.form, 'r') as f:
         for row in csv.reader(f):
             # skip when we have uid for the person
             if row[1].strip() in predef_usernames:
@@ -68,19 +159,43 @@ if __name__ == '__main__':
                 username = up.unquote(username.split('/')[-1])
             usernames[row[1].strip()] = username
 
-    for fullname, username in usernames.items():
-        if username not in uids:
-            uid = find_uid(username)
-            uids[username] = uid
-            sys.stderr.write('.')
-        if username in uids and uids[username] not in classes:
-            clas = find_class(uids[username])
-            classes[uids[username]] = clas
+    cache = UserCache(options.cache or options.output + '.cache.json', options.ttl * 86400)
+
+    # There is no bulk query for display names, so these are looked up concurrently
+    missing = [u for u in set(usernames.values()) if u not in uids]
+    to_query = [u for u in missing if not cache.has('names', u)]
+    with ThreadPoolExecutor(options.jobs) as pool:
+        futures = [(username, pool.submit(find_uid, username)) for username in to_query]
+        for username, future in futures:
+            try:
+                cache.set('names', username, future.result())
+            except requests.RequestException as e:
+                # Not caching errors, so that the name is looked up on the next run
+                sys.stderr.write(f'Could not look up {username}: {e}\n')
             sys.stderr.write('.')
-        sys.stderr.flush()
+            sys.stderr.flush()
+    for username in missing:
+        uids[username] = cache.get('names', username)
+    cache.save()
+
+    # Account metadata for classes is queried in chunks
+    need_class = set(uid for uid in uids.values() if uid and uid not in classes)
+    to_query = [uid for uid in need_class if not cache.has('users', uid)]
+    found = find_users(to_query)
+    for uid in to_query:
+        if uid in found:
+            cache.set('users', uid, found[uid])
+    for uid in need_class:
+        classes[uid] = find_class(cache.get('users', uid))
+    cache.save()
+    sys.stderr.write('\n')
 
     rev = {n: f for f, n in usernames.items()}
-    with open(sys.argv[2], 'w') as f:
+    with open(options.output, 'w') as f:
         w = csv.writer(f)
         for name, uid in uids.items():
             w.writerow([rev[name], name, uid, classes.get(uid)])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,27 +2,45 @@
 from datetime import datetime, timezone
 import sys
 
-if len(sys.argv) > 1 and '-' in sys.argv[1]:
-    if sys.argv[1][0] == '-':
-        # Decode a timestamp. Super-hidden option!
-        try:
-            ts = 60 * (22457216 + int(sys.argv[1][1:]))
-        except ValueError:
-            print('Use either "-state" or a date for the first argument')
-            sys.exit(1)
-        print(datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M'))
+# Overpass augmented diff ids are minutes since this one
+ADIFF_EPOCH = 22457216
+
+
+def current_adiff_id() -> int:
+    """Returns the id of the current minute. The latest available diff is one less."""
+    return int(datetime.now(timezone.utc).timestamp() / 60) - ADIFF_EPOCH
+
+
+def adiff_id_to_time(adiff_id: int) -> datetime:
+    return datetime.utcfromtimestamp(60 * (ADIFF_EPOCH + adiff_id))
+
+
+def time_to_adiff_id(target_time: datetime) -> int:
+    return int(target_time.timestamp() / 60) - ADIFF_EPOCH
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and '-' in sys.argv[1]:
+        if sys.argv[1][0] == '-':
+            # Decode a timestamp. Super-hidden option!
+            try:
+                adiff_id = int(sys.argv[1][1:])
+            except ValueError:
+                print('Use either "-state" or a date for the first argument')
+                sys.exit(1)
+            print(adiff_id_to_time(adiff_id).strftime('%Y-%m-%d %H:%M'))
+        else:
+            try:
+                target_time = datetime.fromisoformat(' '.join(sys.argv[1:]) + '+00:00')
+            except ValueError:
+                print('Please use format YYYY-MM-DDTHH:MM[:SS]')
+                sys.exit(1)
+            if target_time > datetime.now(timezone.utc):
+                print(f'Current UTC time is {datetime.utcnow():%Y-%m-%dt%H:%M}.')
+                sys.exit(1)
+            print(time_to_adiff_id(target_time))
     else:
-        try:
-            target_time = datetime.fromisoformat(' '.join(sys.argv[1:]) + '+00:00')
-        except ValueError:
-            print('Please use format YYYY-MM-DDTHH:MM[:SS]')
-            sys.exit(1)
-        if target_time > datetime.now(timezone.utc):
-            print(f'Current UTC time is {datetime.utcnow():%Y-%m-%dt%H:%M}.')
-            sys.exit(1)
-        print(int(target_time.timestamp() / 60) - 22457216)
-else:
-    now = int(datetime.now(timezone.utc).timestamp() / 60) - 22457216
-    from_ts = int(sys.argv[1]) + 1 if len(sys.argv) > 1 else now - 1
-    for ts in range(from_ts, now):
-        print(ts)
+        now = current_adiff_id()
+        from_ts = int(sys.argv[1]) + 1 if len(sys.argv) > 1 else now - 1
+        for ts in range(from_ts, now):
+            print(ts)
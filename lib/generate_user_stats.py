@@ -4,6 +4,14 @@ import csv
 import sys
 import os
 import json
+import gzip
+import shutil
+import heapq
+import itertools
+import tempfile
+from datetime import datetime, timezone
+from tracker_db import add_psql_arguments, connect, add_row_id
+from profiling import add_profiling_arguments, start_profiling
 
 
 class Weights:
@@ -63,9 +71,9 @@ class Weights:
         return value * self.get(row['osm_id'], row['kind'], row['action'] == 'modify')
 
     def get(self, osm_id, kind, is_modify):
-        typ = row['osm_id'].split('/')[0]
+        typ = osm_id.split('/')[0]
         base = self.types[typ]
-        weight = self.weights.get(row['kind'], [1])
+        weight = self.weights.get(kind, [1])
         if not is_modify:
             return base * weight[0]
         elif len(weight) > 1:
@@ -73,15 +81,593 @@ class Weights:
         return base * weight[0] * self.modify
 
 
-def update_result(result, weights, current, osm_id, kind, region):
+def has_length(row):
+    """Tells rows for ways, which have a length (possibly zero), like "is not null" in SQL."""
+    # Lengths are strings in CSV files and numbers or None when read from the database
+    return row.get('length') not in (None, '')
+
+
+class ObjectState:
+    """Contributions of users to a single (osm_id, kind, region)."""
+    def __init__(self, current=None, last_added=None, last_key=None):
+        self.current = current or {}  # uid -> [created, modified]
+        # uid of the last action if that was "create", negative if that was "delete"
+        self.last_added = last_added
+        # (ts, version) of the latest added row, to tell rows that came late
+        self.last_key = None if not last_key else tuple(last_key)
+
+    def add(self, row):
+        key = (row['ts'], row['version'])
+        if not self.last_key or key > self.last_key:
+            self.last_key = key
+        uid = row['uid']
+        if uid not in self.current:
+            self.current[uid] = [0, 0]
+
+        value = float(row['length']) if has_length(row) else 1.0
+        if row['action'] == 'create':
+            if self.last_added and self.last_added < 0:
+                # When restoring after deletion, count as modification
+                self.current[uid][1] = value
+            else:
+                self.current[uid][0] = value
+            self.last_added = int(uid)
+        elif row['action'] == 'delete':
+            if self.last_added and self.last_added > 0:
+                # Undo last creation if there was one.
+                last = self.current[str(self.last_added)]
+                last[0] = max(0, last[0] - value)
+                last[1] = 0
+            # Count as modification
+            self.current[uid][1] = value
+            self.last_added = -int(uid)
+        elif row['action'] == 'modify':
+            self.current[uid][1] = value
+            # Not emptying last_added, since we allow intermediate
+            # modifications. But a deletion undoes creation.
+        else:
+            raise KeyError(f'Wrong action {row["action"]} for {row["osm_id"]} {row["kind"]}')
+
+    def to_json(self):
+        return json.dumps([self.current, self.last_added, self.last_key])
+
+    @staticmethod
+    def from_json(data):
+        return ObjectState(*json.loads(data))
+
+
+class UserStats:
+    """Everything we need for printing the statistics."""
+    def __init__(self):
+        self.usernames = {}  # uid -> username
+        self.columns = [set(), set()]  # list of columns for nodes and ways
+        self.result = {}  # (uid, region, kind) -> (count, score)
+        # (uid, region, kind, osm type, is_modify) -> value, before applying weights
+        self.values = {}
+        self.min_ts = self.max_ts = None  # plain string
+
+    def add_row(self, row):
+        self.usernames[row['uid']] = row['username']
+        self.columns[1 if has_length(row) else 0].add(row['kind'])
+        if not self.min_ts or row['ts'] < self.min_ts:
+            self.min_ts = row['ts']
+        if not self.max_ts or row['ts'] > self.max_ts:
+            self.max_ts = row['ts']
+
+
+def update_result(result, weights, current, osm_id, kind, region, sign=1):
+    """Adds contributions to the result. Use sign=-1 to subtract them."""
     for uid, contrib in current.items():
         k = (uid, region, kind)
         if k not in result:
             result[k] = [0, 0]
         value = contrib[0] or contrib[1]
         mult = weights.get(osm_id, kind, not contrib[0])
+        result[k][0] += sign * value
+        result[k][1] += sign * value * mult
+
+
+def update_values(values, current, osm_id, kind, region):
+    """Adds contributions to weight-independent sums, see apply_weights()."""
+    typ = osm_id.split('/')[0]
+    for uid, contrib in current.items():
+        k = (uid, region, kind, typ, not contrib[0])
+        values[k] = values.get(k, 0) + (contrib[0] or contrib[1])
+
+
+def apply_weights(values, weights):
+    """Turns value sums from update_values() into (uid, region, kind) -> (count, score)."""
+    result = {}
+    for (uid, region, kind, typ, is_modify), value in values.items():
+        k = (uid, region, kind)
+        if k not in result:
+            result[k] = [0, 0]
         result[k][0] += value
-        result[k][1] += value * mult
+        result[k][1] += value * weights.get(typ, kind, is_modify)
+    return result
+
+
+VALUES_VERSION = 1
+
+
+def save_values(filename, stats):
+    """Writes value sums and everything else needed for printing into a gzipped JSON."""
+    with gzip.open(filename, 'wt', encoding='utf-8') as f:
+        json.dump({
+            'version': VALUES_VERSION,
+            'min_ts': stats.min_ts,
+            'max_ts': stats.max_ts,
+            'usernames': stats.usernames,
+            'columns': [sorted(c) for c in stats.columns],
+            'values': [[*k, v] for k, v in stats.values.items()],
+        }, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def load_values(filename, weights, regions=None):
+    """Reads a file made with save_values() and returns UserStats for given weights."""
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != VALUES_VERSION:
+        raise ValueError(f'Unsupported values file version {data.get("version")}')
+    stats = UserStats()
+    stats.min_ts = data['min_ts']
+    stats.max_ts = data['max_ts']
+    stats.usernames = data['usernames']
+    stats.columns = [set(c) for c in data['columns']]
+    for uid, region, kind, typ, is_modify, value in data['values']:
+        if not regions or region in regions:
+            stats.values[(uid, region, kind, typ, is_modify)] = value
+    stats.result = apply_weights(stats.values, weights)
+    return stats
+
+
+def prepare_row(row):
+    """For joined (deleted) ways, swap osm_id and parent_id."""
+    if row['obj_action'] == 'join':
+        row['osm_id'], row['prev_id'] = row['prev_id'], row['osm_id']
+    return row
+
+
+def row_sort_key(r):
+    return (r['osm_id'], r['kind'], r['ts'], r['version'])
+
+
+def external_sort(rows, key, chunk_size):
+    """
+    Sorts rows (dicts) with a limited memory: sorted chunks are
+    written to temporary CSV files, and then merged.
+    """
+    chunks = []
+    fieldnames = None
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            break
+        chunk.sort(key=key)
+        if fieldnames is None:
+            fieldnames = list(chunk[0].keys())
+        f = tempfile.TemporaryFile('w+', newline='')
+        w = csv.DictWriter(f, fieldnames)
+        w.writerows(chunk)
+        f.seek(0)
+        chunks.append(f)
+    readers = [csv.DictReader(f, fieldnames) for f in chunks]
+    yield from heapq.merge(*readers, key=key)
+    for f in chunks:
+        f.close()
+
+
+def parse_ts(value):
+    """Parses an ISO date or timestamp, with "Z" or a "+00" offset, naive ones taken as UTC."""
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    elif len(value) > 10 and value[-3] in '+-' and value[-2:].isdigit():
+        # PostgreSQL writes offsets without minutes
+        value += ':00'
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+
+def filter_rows(rows, ts_from=None, ts_to=None, regions=None):
+    """Keeps rows with ts_from <= ts < ts_to in given regions. Timestamps are ISO strings."""
+    ts_from = parse_ts(ts_from) if ts_from else None
+    ts_to = parse_ts(ts_to) if ts_to else None
+    for row in rows:
+        if ts_from or ts_to:
+            ts = parse_ts(row['ts'])
+            if ts_from and ts < ts_from:
+                continue
+            if ts_to and ts >= ts_to:
+                continue
+        if regions and row['region'] not in regions:
+            continue
+        yield row
+
+
+def filter_sql(ts_from=None, ts_to=None, regions=None):
+    """Returns a "where" clause and its parameters for the same filters as filter_rows()."""
+    # Pushed down to queries, so that only relevant partitions are read
+    conditions = []
+    params = []
+    if ts_from:
+        conditions.append('ts >= %s')
+        params.append(ts_from)
+    if ts_to:
+        conditions.append('ts < %s')
+        params.append(ts_to)
+    if regions:
+        conditions.append('region = any(%s)')
+        params.append(list(regions))
+    return ('' if not conditions else 'where ' + ' and '.join(conditions)), params
+
+
+def read_tracker_rows(conn, table, where='', params=()):
+    """Streams rows from a tracker table, sorted for calculate() and with ids of joins swapped."""
+    with conn.cursor() as cur:
+        cur.execute("set timezone to 'UTC'")
+    keys = ('ts', 'action', 'obj_action', 'kind', 'uid', 'username',
+            'osm_id', 'version', 'prev_id', 'region', 'length')
+    with conn.cursor('tracker_rows') as cur:
+        cur.itersize = 10000
+        cur.execute(f"""select ts::text, action, obj_action, kind, uid::text, username,
+            case when obj_action = 'join' then prev_id else osm_id end as osm_id,
+            version::text,
+            coalesce(case when obj_action = 'join' then osm_id else prev_id end, ''),
+            coalesce(region, '') as region, length
+            from {table} {where}
+            order by 7, kind, region, ts, version::text""", params)
+        for r in cur:
+            yield dict(zip(keys, r))
+
+
+def calculate(rows, weights, stats):
+    """Replays sorted rows and adds up user contributions into stats."""
+    state = None
+    osm_id_kind = None  # (osm_id, kind, region)
+    for row in rows:
+        oik = (row['osm_id'], row['kind'], row['region'])
+        if osm_id_kind != oik:
+            if osm_id_kind:
+                update_values(stats.values, state.current, *osm_id_kind)
+            state = ObjectState()
+            osm_id_kind = oik
+        stats.add_row(row)
+        state.add(row)
+    if osm_id_kind:
+        update_values(stats.values, state.current, *osm_id_kind)
+    # Weights are applied to sums, not to every object
+    stats.result = apply_weights(stats.values, weights)
+
+
+class IncrementalStats:
+    """
+    Keeps object states and user totals in tables next to the tracker table,
+    and updates them only with rows added after the last counted row_id.
+    """
+    def __init__(self, conn, table, weights):
+        self.conn = conn
+        self.table = table
+        self.weights = weights
+        # Keys of counted rows, before row_id was used. Only dropped now.
+        self.t_counted = f'{table}_counted'
+        self.t_objects = f'{table}_objstate'  # ObjectState for (osm_id, kind, region)
+        self.t_totals = f'{table}_totals'  # (uid, region, kind) -> (count, score)
+        self.t_users = f'{table}_users'  # uid -> username
+        self.t_kinds = f'{table}_kinds'  # kind -> whether it's for ways
+        self.t_meta = f'{table}_statsmeta'  # weights, timestamp range and last row_id
+
+    def create_tables(self, cur):
+        cur.execute(f"""create table if not exists {self.t_objects} (
+            osm_id text, kind text, region text, state text not null,
+            primary key (osm_id, kind, region))""")
+        cur.execute(f"""create table if not exists {self.t_totals} (
+            uid text, region text, kind text,
+            count double precision not null, score double precision not null,
+            primary key (uid, region, kind))""")
+        cur.execute(f"""create table if not exists {self.t_users} (
+            uid text primary key, username text not null)""")
+        cur.execute(f"""create table if not exists {self.t_kinds} (
+            kind text, is_way boolean, primary key (kind, is_way))""")
+        cur.execute(f"""create table if not exists {self.t_meta} (
+            weights text, min_ts text, max_ts text, last_row_id bigint)""")
+        cur.execute(f"alter table {self.t_meta} add column if not exists last_row_id bigint")
+
+    def drop(self):
+        with self.conn.cursor() as cur:
+            for t in (self.t_counted, self.t_objects, self.t_totals,
+                      self.t_users, self.t_kinds, self.t_meta):
+                cur.execute(f"drop table if exists {t}")
+        self.conn.commit()
+
+    def weights_key(self):
+        w = self.weights
+        return json.dumps([w.modify, w.types, w.weights], sort_keys=True)
+
+    def recalculate_totals(self, cur):
+        """Weights have changed, so we rebuild totals from object states."""
+        result = {}
+        cur.execute(f"select osm_id, kind, region, state from {self.t_objects}")
+        for osm_id, kind, region, state in cur.fetchall():
+            update_result(result, self.weights, ObjectState.from_json(state).current,
+                          osm_id, kind, region)
+        cur.execute(f"truncate {self.t_totals}")
+        self.add_totals(cur, result)
+
+    def add_totals(self, cur, delta):
+        from psycopg2.extras import execute_values
+        execute_values(
+            cur, f"""insert into {self.t_totals} (uid, region, kind, count, score)
+            values %s on conflict (uid, region, kind) do update set
+            count = {self.t_totals}.count + EXCLUDED.count,
+            score = {self.t_totals}.score + EXCLUDED.score""",
+            [(k[0], k[1], k[2], v[0], v[1]) for k, v in delta.items()])
+
+    def select_rows(self, cur, where, params):
+        cur.execute(f"""select ts::text, action, obj_action, kind, uid::text,
+            username, osm_id, version::text, coalesce(prev_id, ''),
+            coalesce(region, ''), length, row_id
+            from {self.table} where {where}""", params)
+        keys = ('ts', 'action', 'obj_action', 'kind', 'uid', 'username',
+                'osm_id', 'version', 'prev_id', 'region', 'length', 'row_id')
+        return [dict(zip(keys, r)) for r in cur.fetchall()]
+
+    def read_new_rows(self, cur, last_row_id):
+        """Returns rows added after last_row_id, and the largest row_id among them."""
+        rows = self.select_rows(cur, 'row_id > %s', (last_row_id,))
+        return rows, max([last_row_id] + [r['row_id'] for r in rows])
+
+    def read_group_rows(self, cur, groups, last_row_id):
+        """Returns a dict of (osm_id, kind, region) -> all rows up to last_row_id, sorted."""
+        result = {}
+        groups = list(groups)
+        for i in range(0, len(groups), 1000):
+            rows = self.select_rows(
+                cur, """row_id <= %s and (case when obj_action = 'join' then prev_id
+                else osm_id end, kind, coalesce(region, '')) in %s""",
+                (last_row_id, tuple(groups[i:i+1000])))
+            for row in rows:
+                row = prepare_row(row)
+                result.setdefault((row['osm_id'], row['kind'], row['region']), []).append(row)
+        for rows in result.values():
+            rows.sort(key=row_sort_key)
+        return result
+
+    def read_states(self, cur, groups):
+        """Returns a dict of (osm_id, kind, region) -> ObjectState for existing groups."""
+        states = {}
+        groups = list(groups)
+        for i in range(0, len(groups), 1000):
+            cur.execute(f"""select osm_id, kind, region, state from {self.t_objects}
+                where (osm_id, kind, region) in %s""", (tuple(groups[i:i+1000]),))
+            for osm_id, kind, region, state in cur.fetchall():
+                states[(osm_id, kind, region)] = ObjectState.from_json(state)
+        return states
+
+    def update(self):
+        """Counts new rows of the tracker table."""
+        from psycopg2.extras import execute_values
+        with self.conn.cursor() as cur:
+            cur.execute("set timezone to 'UTC'")
+            # Two updates at once would count the same rows twice. This lock conflicts
+            # with itself, and also waits for loads into the tracker table to finish.
+            # With the lock, no row with a smaller row_id can be committed later.
+            cur.execute(f"lock table {self.table} in share row exclusive mode")
+            add_row_id(cur, self.table)
+            self.create_tables(cur)
+            cur.execute(f"select weights, min_ts, max_ts, last_row_id from {self.t_meta}")
+            meta = cur.fetchone()
+            if meta and meta[3] is None:
+                # Counted before row_id was used, so starting over
+                cur.execute(f"truncate {self.t_objects}, {self.t_totals}")
+                cur.execute(f"drop table if exists {self.t_counted}")
+                meta = None
+            elif meta and meta[0] != self.weights_key():
+                self.recalculate_totals(cur)
+
+            rows, last_row_id = self.read_new_rows(cur, 0 if not meta else meta[3])
+            rows = [prepare_row(r) for r in rows]
+            rows.sort(key=row_sort_key)
+            stats = UserStats()
+            groups = {}  # (osm_id, kind, region) -> list of rows
+            for row in rows:
+                stats.add_row(row)
+                groups.setdefault((row['osm_id'], row['kind'], row['region']), []).append(row)
+
+            # Replay new rows over stored states, and remember the difference in totals
+            states = self.read_states(cur, groups.keys())
+            # Rows older than the last counted one for an object (e.g. from a backfill)
+            # cannot be added on top, so these objects are replayed from all their rows
+            late = {oik for oik, group_rows in groups.items() if oik in states and
+                    states[oik].last_key and
+                    (group_rows[0]['ts'], group_rows[0]['version']) < states[oik].last_key}
+            groups.update(self.read_group_rows(cur, late, last_row_id))
+            delta = {}
+            for oik, group_rows in groups.items():
+                state = states.get(oik)
+                if state:
+                    update_result(delta, self.weights, state.current, *oik, sign=-1)
+                if not state or oik in late:
+                    state = states[oik] = ObjectState()
+                for row in group_rows:
+                    state.add(row)
+                update_result(delta, self.weights, state.current, *oik)
+
+            execute_values(
+                cur, f"""insert into {self.t_objects} (osm_id, kind, region, state)
+                values %s on conflict (osm_id, kind, region)
+                do update set state = EXCLUDED.state""",
+                [(k[0], k[1], k[2], states[k].to_json()) for k in groups])
+            self.add_totals(cur, delta)
+            execute_values(
+                cur, f"""insert into {self.t_users} (uid, username) values %s
+                on conflict (uid) do update set username = EXCLUDED.username""",
+                list(stats.usernames.items()))
+            execute_values(
+                cur, f"insert into {self.t_kinds} (kind, is_way) values %s on conflict do nothing",
+                [(k, i == 1) for i in range(2) for k in stats.columns[i]])
+
+            ts_range = [t for t in (stats.min_ts, stats.max_ts) + (meta[1:3] if meta else ())
+                        if t]
+            min_ts = None if not ts_range else min(ts_range)
+            max_ts = None if not ts_range else max(ts_range)
+            cur.execute(f"delete from {self.t_meta}")
+            cur.execute(f"""insert into {self.t_meta} (weights, min_ts, max_ts, last_row_id)
+                values (%s, %s, %s, %s)""", (self.weights_key(), min_ts, max_ts, last_row_id))
+        self.conn.commit()
+
+    def read(self):
+        """Returns UserStats made from the aggregate tables."""
+        stats = UserStats()
+        with self.conn.cursor() as cur:
+            cur.execute(f"select uid, region, kind, count, score from {self.t_totals}")
+            for uid, region, kind, count, score in cur:
+                stats.result[(uid, region, kind)] = [count, score]
+            cur.execute(f"select uid, username from {self.t_users}")
+            stats.usernames = dict(cur.fetchall())
+            cur.execute(f"select kind, is_way from {self.t_kinds}")
+            for kind, is_way in cur:
+                stats.columns[1 if is_way else 0].add(kind)
+            cur.execute(f"select min_ts, max_ts from {self.t_meta}")
+            row = cur.fetchone()
+            if row:
+                stats.min_ts, stats.max_ts = row
+        return stats
+
+    def read_values(self, stats):
+        """Fills stats.values from stored object states, for save_values()."""
+        with self.conn.cursor() as cur:
+            cur.execute(f"select osm_id, kind, region, state from {self.t_objects}")
+            for osm_id, kind, region, state in cur:
+                update_values(stats.values, ObjectState.from_json(state).current,
+                              osm_id, kind, region)
+
+
+# The same as ObjectState.add(), as an aggregate function for PostgreSQL.
+# Made in pg_temp for each session, so that no rights on the schema are needed.
+SQL_SCORE_FUNCTIONS = """
+create or replace function pg_temp.stats_score_step(
+    state jsonb, action text, uid text, value double precision
+) returns jsonb language plpgsql immutable as $$
+declare
+    cur jsonb := coalesce(state->'c', '{}'::jsonb);
+    last_added bigint := coalesce((state->>'l')::bigint, 0);
+    last_uid text;
+begin
+    if not cur ? uid then
+        cur := jsonb_set(cur, array[uid], '[0, 0]'::jsonb);
+    end if;
+    if action = 'create' then
+        if last_added < 0 then
+            -- When restoring after deletion, count as modification
+            cur := jsonb_set(cur, array[uid, '1'], to_jsonb(value));
+        else
+            cur := jsonb_set(cur, array[uid, '0'], to_jsonb(value));
+        end if;
+        last_added := uid::bigint;
+    elsif action = 'delete' then
+        if last_added > 0 then
+            -- Undo last creation if there was one.
+            last_uid := last_added::text;
+            cur := jsonb_set(cur, array[last_uid, '0'], to_jsonb(
+                greatest(0, (cur->last_uid->>0)::double precision - value)));
+            cur := jsonb_set(cur, array[last_uid, '1'], to_jsonb(0));
+        end if;
+        -- Count as modification
+        cur := jsonb_set(cur, array[uid, '1'], to_jsonb(value));
+        last_added := -uid::bigint;
+    elsif action = 'modify' then
+        cur := jsonb_set(cur, array[uid, '1'], to_jsonb(value));
+    else
+        raise exception 'Wrong action %', action;
+    end if;
+    return jsonb_build_object('c', cur, 'l', last_added);
+end $$;
+
+drop aggregate if exists pg_temp.stats_score(text, text, double precision);
+create aggregate pg_temp.stats_score(text, text, double precision) (
+    sfunc = pg_temp.stats_score_step, stype = jsonb, initcond = '{}'
+);
+"""
+
+
+class SqlStats:
+    """
+    Calculates (uid, region, kind) -> (count, score) inside PostgreSQL,
+    so that only the totals are sent back.
+    """
+    def __init__(self, conn, table, weights, ts_from=None, ts_to=None, regions=None):
+        self.conn = conn
+        self.table = table
+        self.weights = weights
+        self.where, self.params = filter_sql(ts_from, ts_to, regions)
+
+    def load_weights(self, cur):
+        from psycopg2.extras import execute_values
+        cur.execute("""create temporary table if not exists stats_type_weights (
+            typ text primary key, base double precision not null)""")
+        cur.execute("""create temporary table if not exists stats_kind_weights (
+            kind text primary key, weight double precision not null,
+            modify_weight double precision)""")
+        cur.execute("truncate stats_type_weights, stats_kind_weights")
+        execute_values(cur, "insert into stats_type_weights (typ, base) values %s",
+                       list(self.weights.types.items()))
+        execute_values(
+            cur, "insert into stats_kind_weights (kind, weight, modify_weight) values %s",
+            [(k, w[0], None if len(w) < 2 else w[1]) for k, w in self.weights.weights.items()])
+
+    def read(self):
+        """Returns UserStats calculated from the tracker table."""
+        stats = UserStats()
+        with self.conn.cursor() as cur:
+            cur.execute("set timezone to 'UTC'")
+            cur.execute(SQL_SCORE_FUNCTIONS)
+            self.load_weights(cur)
+            # Versions are compared as strings, like when sorting a CSV.
+            cur.execute(f"""
+            with states as (
+                select osm_id, kind, region, pg_temp.stats_score(
+                    action, uid::text, coalesce(length, 1)::double precision
+                    order by ts, version::text) as state
+                from (
+                    select case when obj_action = 'join' then prev_id else osm_id end as osm_id,
+                    kind, coalesce(region, '') as region, action, uid, length, ts, version
+                    from {self.table} {self.where}
+                ) t group by osm_id, kind, region
+            ), contrib as (
+                select s.osm_id, s.kind, s.region, c.key as uid,
+                    (c.value->>0)::double precision as created,
+                    (c.value->>1)::double precision as modified
+                from states s, jsonb_each(s.state->'c') c
+            )
+            select uid, region, c.kind,
+                sum(case when created <> 0 then created else modified end),
+                sum(case when created <> 0 then created else modified end * tw.base *
+                    case when created <> 0 then coalesce(kw.weight, 1)
+                    when kw.modify_weight is not null then kw.modify_weight
+                    else coalesce(kw.weight, 1) * %s end)
+            from contrib c
+            join stats_type_weights tw on tw.typ = split_part(c.osm_id, '/', 1)
+            left join stats_kind_weights kw on kw.kind = c.kind
+            group by uid, region, c.kind""", self.params + [self.weights.modify])
+            for uid, region, kind, count, score in cur:
+                stats.result[(uid, region, kind)] = [count, score]
+
+            cur.execute(f"""select distinct on (uid) uid::text, username
+                from {self.table} {self.where} order by uid, ts desc""", self.params)
+            stats.usernames = dict(cur.fetchall())
+            cur.execute(f"select distinct kind, length is not null from {self.table} {self.where}",
+                        self.params)
+            for kind, is_way in cur:
+                stats.columns[1 if is_way else 0].add(kind)
+            cur.execute(f"select min(ts)::text, max(ts)::text from {self.table} {self.where}",
+                        self.params)
+            stats.min_ts, stats.max_ts = cur.fetchone()
+        self.conn.rollback()
+        return stats
 
 
 def count_by_user(result, region=None):
@@ -131,8 +717,128 @@ def drop_user(users, usernames, uid):
     return users and uid not in users and usernames[uid] not in users
 
 
-if __name__ == '__main__':
+def get_columns(stats, usergroups):
+    columns = ['user'] + sorted(stats.columns[0]) + sorted(stats.columns[1])
+    if usergroups:
+        columns.append('usergroup')
+    columns.append('score')
+    return columns
+
+
+def write_csv(output, stats, weights, users, usergroups):
+    columns = get_columns(stats, usergroups)
+    usernames = stats.usernames
+    data = count_by_user(stats.result)
+    for uid in list(data.keys()):
+        if drop_user(users, usernames, uid):
+            del data[uid]
+            continue
+        data[uid]['user'] = usernames[uid]
+        if usergroups:
+            group = usergroups.get(uid) or usergroups.get(usernames[uid])
+            data[uid]['usergroup'] = weights.usergroups.get(group, group)
+
+    w = csv.DictWriter(output, columns)
+    w.writerow({c: weights.labels.get(c, c) for c in columns})
+    for row in sorted(data.values(), key=lambda r: r['score'], reverse=True):
+        w.writerow(row)
+
+
+def write_html(output, stats, weights, users, usergroups):
+    columns = get_columns(stats, usergroups)
+    usernames = stats.usernames
+    json_data = prepare_json(stats.result)
+    json_data = [r for r in json_data if not drop_user(users, usernames, r['uid'])]
+    for row in json_data:
+        row['user'] = usernames[row['uid']]
+        if usergroups:
+            group = usergroups.get(row['uid']) or usergroups.get(row['user'])
+            row['usergroup'] = weights.usergroups.get(group, group)
+    template = open(os.path.join(
+        os.path.dirname(__file__), 'user_stats_template.html'
+    ), 'r').read()
+    template = template.replace('{{min_ts}}', stats.min_ts or '')
+    template = template.replace('{{max_ts}}', stats.max_ts or '')
+    template = template.replace('{{usergroups}}', json.dumps(
+        weights.usergroups, ensure_ascii=False))
+    template = template.replace('{{columns}}', json.dumps(columns, ensure_ascii=False))
+    template = template.replace('{{tr_columns}}', json.dumps(
+        [weights.labels.get(c, c) for c in columns], ensure_ascii=False))
+    template = template.replace('{{data}}', json.dumps(json_data, ensure_ascii=False))
+    output.write(template)
+
+
+def read_users(fileobj):
+    """Reads a CSV made with form_to_uid.py, returns a set of users and a dict of groups."""
+    users = set()
+    usergroups = {}
+    for row in csv.reader(fileobj):
+        users.add(row[2] or row[1])
+        if len(row) > 3 and row[3].strip():
+            usergroups[row[2] or row[1]] = row[3].strip()
+    return users, usergroups
+
+
+def build_shards(stats, weights, users, usergroups, suffix='.json.gz'):
+    """
+    Returns an index and a dict of file name -> table for each region,
+    with rows as lists of column values, pre-sorted by score.
+    """
+    columns = get_columns(stats, usergroups)
+    usernames = stats.usernames
+    regions = sorted(set(k[1] for k in stats.result if k[1]))
+    index_regions = []
+    tables = {}
+    for i, region in enumerate([None] + regions):
+        data = count_by_user(stats.result, region)
+        table = []
+        for uid, row in data.items():
+            if drop_user(users, usernames, uid):
+                continue
+            row['user'] = usernames[uid]
+            if usergroups:
+                group = usergroups.get(uid) or usergroups.get(usernames[uid])
+                row['usergroup'] = weights.usergroups.get(group, group)
+            table.append([row.get(c) for c in columns])
+        table.sort(key=lambda r: r[-1], reverse=True)
+        filename = ('all' if region is None else f'region_{i}') + suffix
+        tables[filename] = table
+        index_regions.append({
+            'name': region or weights.labels.get('all', 'Все'),
+            'file': filename,
+            'users': len(table),
+        })
+
+    index = {
+        'min_ts': stats.min_ts,
+        'max_ts': stats.max_ts,
+        'columns': columns,
+        'labels': [weights.labels.get(c, c) for c in columns],
+        'usergroups': weights.usergroups,
+        'regions': index_regions,
+    }
+    return index, tables
+
+
+def write_shards(path, stats, weights, users, usergroups):
+    """
+    Writes a gzipped JSON file for each region, pre-sorted by score,
+    with an index.json and a page that loads regions on demand.
+    """
+    os.makedirs(path, exist_ok=True)
+    index, tables = build_shards(stats, weights, users, usergroups)
+    for filename, table in tables.items():
+        with gzip.open(os.path.join(path, filename), 'wt', encoding='utf-8') as f:
+            json.dump(table, f, ensure_ascii=False, separators=(',', ':'))
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f, ensure_ascii=False)
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), 'user_stats_shards.html'),
+                    os.path.join(path, 'index.html'))
+
+
+def main(argv=None, prog=None):
     parser = argparse.ArgumentParser(
+        prog=prog,
         description='Reads a PostgreSQL adiff table and calculates user statistics.')
     parser.add_argument('-i', '--input', type=argparse.FileType('r'), default=sys.stdin,
                         help='CSV file from psql, with header')
@@ -144,115 +850,108 @@ if __name__ == '__main__':
                         help='Definitions for weights for change types')
     parser.add_argument('--csv', action='store_true',
                         help='Write CSV instead of HTML')
-    options = parser.parse_args()
+    parser.add_argument('--shards',
+                        help='Instead of a single HTML, write a page with per-region '
+                        'JSON files into this directory')
+    parser.add_argument('--sorted', action='store_true',
+                        help='Input is sorted by osm_id, kind, region, ts, version, '
+                        'with osm_id and prev_id swapped for joins')
+    parser.add_argument('--save-values',
+                        help='Also save weight-independent sums into this file, '
+                        'to try other weights with --values')
+    parser.add_argument('--values',
+                        help='Read sums saved with --save-values instead of rows, '
+                        'and apply weights to these')
+    parser.add_argument('--sort-buffer', type=int,
+                        help='Sort unsorted input on disk with this many rows in memory')
+    parser.add_argument('--from', dest='ts_from',
+                        help='Count only changes made at or after this UTC date or timestamp')
+    parser.add_argument('--to', dest='ts_to',
+                        help='Count only changes made before this UTC date or timestamp')
+    parser.add_argument('--region', action='append',
+                        help='Count only changes in this region, can be repeated')
+    parser.add_argument('-p', '--table', default='osc_tracker',
+                        help='Tracker table to read with --database, default is osc_tracker')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='With --database, recalculate aggregates from scratch')
+    parser.add_argument('--sql', action='store_true',
+                        help='With --database, calculate everything inside PostgreSQL')
+    add_profiling_arguments(parser)
+    add_psql_arguments(parser)
+    options = parser.parse_args(argv)
+    profiler = start_profiling(options)
+    try:
+        weights = Weights(options.weights)
+        users = set()
+        usergroups = {}
+        if options.users:
+            users, usergroups = read_users(options.users)
 
-    weights = Weights(options.weights)
-    users = set()
-    usergroups = {}
-    if options.users:
-        for row in csv.reader(options.users):
-            users.add(row[2] or row[1])
-            if len(row) > 3 and row[3].strip():
-                usergroups[row[2] or row[1]] = row[3].strip()
-
-    reader = csv.DictReader(options.input)
-    rows = [r for r in reader]
-    # For joined (deleted) ways, swap osm_id and parent_id
-    for r in rows:
-        if r['obj_action'] == 'join':
-            r['osm_id'], r['prev_id'] = r['prev_id'], r['osm_id']
-    rows.sort(key=lambda r: (r['osm_id'], r['kind'], r['ts'], r['version']))
-
-    # Gathering data
-    usernames = {}  # uid -> username
-    columns = [set(), set()]  # list of columns for nodes and ways
-    current = {}  # uid -> (n_created, n_modified)
-    last_added = None  # uid of the last action if that was "create",
-    # negative if that was "delete"
-    osm_id_kind = None  # (osm_id, kind, region)
-    result = {}  # (uid, region, kind) -> (count, score)
-    min_ts = max_ts = None  # plain string
-    for row in rows:
-        oik = (row['osm_id'], row['kind'], row['region'])
-        if osm_id_kind != oik:
-            if osm_id_kind:
-                update_result(result, weights, current, osm_id_kind[0],
-                              osm_id_kind[1], osm_id_kind[2])
-            current = {}
-            last_added = None
-            osm_id_kind = oik
-        uid = row['uid']
-        usernames[uid] = row['username']
-        columns[1 if row['length'] else 0].add(row['kind'])
-        if not min_ts or row['ts'] < min_ts:
-            min_ts = row['ts']
-        if not max_ts or row['ts'] > max_ts:
-            max_ts = row['ts']
-        if uid not in current:
-            current[uid] = [0, 0]
-
-        value = float(row.get('length') or 1)
-        if row['action'] == 'create':
-            if last_added and last_added < 0:
-                # When restoring after deletion, count as modification
-                current[uid][1] = value
+        has_filters = options.ts_from or options.ts_to or options.region
+        if options.values and (options.ts_from or options.ts_to):
+            parser.error('Saved values cannot be filtered by time')
+        for ts in (options.ts_from, options.ts_to):
+            try:
+                if ts:
+                    parse_ts(ts)
+            except ValueError:
+                parser.error(f'Cannot parse timestamp {ts}')
+        if options.save_values and options.sql:
+            parser.error('Values cannot be saved with --sql')
+
+        if options.values:
+            stats = load_values(options.values, weights, options.region)
+        elif options.database and options.sql:
+            conn = connect(options)
+            stats = SqlStats(conn, options.table, weights,
+                             options.ts_from, options.ts_to, options.region).read()
+            conn.close()
+        elif options.database and has_filters:
+            # Aggregate tables are for the whole contest, so filtered rows are replayed
+            conn = connect(options)
+            stats = UserStats()
+            calculate(read_tracker_rows(conn, options.table, *filter_sql(
+                options.ts_from, options.ts_to, options.region)), weights, stats)
+            conn.close()
+        elif options.database:
+            # Update aggregate tables with new rows and read stats from these
+            conn = connect(options)
+            agg = IncrementalStats(conn, options.table, weights)
+            if options.rebuild:
+                agg.drop()
+            agg.update()
+            stats = agg.read()
+            if options.save_values:
+                agg.read_values(stats)
+            conn.close()
+        else:
+            reader = filter_rows(csv.DictReader(options.input),
+                                 options.ts_from, options.ts_to, options.region)
+            if options.sorted:
+                # Streaming rows in a single pass
+                rows = reader
+            elif options.sort_buffer:
+                rows = external_sort((prepare_row(r) for r in reader),
+                                     row_sort_key, options.sort_buffer)
             else:
-                current[uid][0] = value
-            last_added = int(uid)
-        elif row['action'] == 'delete':
-            if last_added and last_added > 0:
-                # Undo last creation if there was one.
-                current[str(last_added)][0] = max(0, current[str(last_added)][0] - value)
-                current[str(last_added)][1] = 0
-            # Count as modification
-            current[uid][1] = value
-            last_added = -int(uid)
-        elif row['action'] == 'modify':
-            current[uid][1] = value
-            # Not emptying last_added, since we allow intermediate
-            # modifications. But a deletion undoes creation.
+                rows = [prepare_row(r) for r in reader]
+                rows.sort(key=row_sort_key)
+            stats = UserStats()
+            calculate(rows, weights, stats)
+
+        if options.save_values:
+            save_values(options.save_values, stats)
+
+        # Writing the result
+        if options.shards:
+            write_shards(options.shards, stats, weights, users, usergroups)
+        elif options.csv:
+            write_csv(options.output, stats, weights, users, usergroups)
         else:
-            raise KeyError(f'Wrong action {row["action"]} for {osm_id_kind}')
-    update_result(result, weights, current, osm_id_kind[0],
-                  osm_id_kind[1], osm_id_kind[2])
+            write_html(options.output, stats, weights, users, usergroups)
+    finally:
+        profiler.stop()
 
-    # Writing the result
-    columns = ['user'] + sorted(columns[0]) + sorted(columns[1])
-    if usergroups:
-        columns.append('usergroup')
-    columns.append('score')
-    if options.csv:
-        data = count_by_user(result)
-        for uid in list(data.keys()):
-            if drop_user(users, usernames, uid):
-                del data[uid]
-                continue
-            data[uid]['user'] = usernames[uid]
-            if usergroups:
-                group = usergroups.get(uid) or usergroups.get(usernames[uid])
-                data[uid]['usergroup'] = weights.usergroups.get(group, group)
-
-        w = csv.DictWriter(options.output, columns)
-        w.writerow({c: weights.labels.get(c, c) for c in columns})
-        for row in sorted(data.values(), key=lambda r: r['score'], reverse=True):
-            w.writerow(row)
-    else:
-        json_data = prepare_json(result)
-        json_data = [r for r in json_data if not drop_user(users, usernames, r['uid'])]
-        for row in json_data:
-            row['user'] = usernames[row['uid']]
-            if usergroups:
-                group = usergroups.get(row['uid']) or usergroups.get(row['user'])
-                row['usergroup'] = weights.usergroups.get(group, group)
-        template = open(os.path.join(
-            os.path.dirname(__file__), 'user_stats_template.html'
-        ), 'r').read()
-        template = template.replace('{{min_ts}}', min_ts)
-        template = template.replace('{{max_ts}}', max_ts)
-        template = template.replace('{{usergroups}}', json.dumps(
-            weights.usergroups, ensure_ascii=False))
-        template = template.replace('{{columns}}', json.dumps(columns, ensure_ascii=False))
-        template = template.replace('{{tr_columns}}', json.dumps(
-            [weights.labels.get(c, c) for c in columns], ensure_ascii=False))
-        template = template.replace('{{data}}', json.dumps(json_data, ensure_ascii=False))
-        options.output.write(template)
+
+if __name__ == '__main__':
+    main()
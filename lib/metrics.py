@@ -0,0 +1,75 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Wall and CPU time for processing stages, and counters, for a single run."""
+    def __init__(self):
+        self.stages = {}  # name -> [wall seconds, cpu seconds]
+        self.counters = {}  # name -> number
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            times = self.stages.setdefault(name, [0, 0])
+            times[0] += time.perf_counter() - wall
+            times[1] += time.process_time() - cpu
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self, **extra):
+        result = dict(extra)
+        result['stages'] = {k: {'wall': round(v[0], 4), 'cpu': round(v[1], 4)}
+                            for k, v in self.stages.items()}
+        result['counters'] = dict(self.counters)
+        return result
+
+    def write_json(self, filename, **extra):
+        """Appends a JSON line with all metrics to the file."""
+        with open(filename, 'a') as f:
+            f.write(json.dumps(self.to_dict(**extra), ensure_ascii=False) + '\n')
+
+    def write_prometheus(self, filename, script):
+        """Writes a textfile for node_exporter, replacing it atomically."""
+        lines = [
+            '# TYPE osm_changes_stage_seconds gauge',
+        ]
+        for name, (wall, cpu) in sorted(self.stages.items()):
+            for kind, value in (('wall', wall), ('cpu', cpu)):
+                lines.append(f'osm_changes_stage_seconds{{script="{script}",stage="{name}",'
+                             f'time="{kind}"}} {value:.4f}')
+        lines.append('# TYPE osm_changes_count gauge')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'osm_changes_count{{script="{script}",name="{name}"}} {value}')
+        lines.append('# TYPE osm_changes_last_run_timestamp_seconds gauge')
+        lines.append(f'osm_changes_last_run_timestamp_seconds{{script="{script}"}} '
+                     f'{int(time.time())}')
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, filename)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics',
+                        help='Append a JSON line with timings and counters to this file')
+    parser.add_argument('--prometheus',
+                        help='Write timings and counters to this node_exporter textfile')
+
+
+def write_metrics(options, script, **extra):
+    if options.metrics:
+        metrics.write_json(options.metrics, script=script, **extra)
+    if options.prometheus:
+        metrics.write_prometheus(options.prometheus, script)
+
+
+# Shared by all modules in a process
+metrics = Metrics()
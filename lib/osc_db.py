@@ -1,15 +1,17 @@
 import json
-from psycopg2.extras import execute_values
+from metrics import metrics
 
 
 TABLE_OBJECTS = 'osc_watched_objects'
 TABLE_LOCATIONS = 'osc_node_locations'
+TABLE_RULES = 'osc_tag_rules'
 COORD_MULTIPLIER = 10000000
 FULL_TYPES = {'n': 'node', 'w': 'way', 'r': 'relation'}
 
 
 class StoredObject:
-    def __init__(self, typ, osm_id, version, tags, nodes=None):
+    def __init__(self, typ, osm_id, version, tags, nodes=None,
+                 bounds=None, length=None, region=None):
         self.typ = FULL_TYPES[typ[0].lower()]
         self.osm_id = int(osm_id)
         self.version = int(version)
@@ -21,6 +23,22 @@ class StoredObject:
             # Also clears nodes if it's an empty list
             self.nodes = None if not nodes else [str(n) for n in nodes]
         self.tags = json.loads(tags) if isinstance(tags, str) else tags
+        # Geometry at the last save: (minlat, minlon, maxlat, maxlon),
+        # way length in meters and a region name.
+        self.bounds = None if bounds is None or bounds[0] is None else tuple(bounds)
+        self.length = length
+        self.region = region
+
+    @property
+    def has_geometry(self):
+        """Whether bounds and length can be used instead of node locations."""
+        return self.bounds is not None and (self.typ != 'way' or self.length is not None)
+
+    @property
+    def centroid(self):
+        """Returns (lat, lon) of the center of bounds."""
+        b = self.bounds
+        return (b[0] + b[2]) / 2, (b[1] + b[3]) / 2
 
     @property
     def nodes_str(self):
@@ -46,48 +64,140 @@ class OscDatabase:
     def create_tables(self):
         self.cur.execute(f"drop table if exists {TABLE_OBJECTS}")
         self.cur.execute(f"drop table if exists {TABLE_LOCATIONS}")
+        self.cur.execute(f"drop table if exists {TABLE_RULES}")
         self.cur.execute(f"""create table {TABLE_OBJECTS} (
             osm_id text primary key,
             version integer,
             tags text,
-            nodes text)""")
+            nodes text,
+            minlat double precision,
+            minlon double precision,
+            maxlat double precision,
+            maxlon double precision,
+            length integer,
+            region text)""")
+        self.create_nodes_index()
         self.cur.execute(f"""create table {TABLE_LOCATIONS} (
             node_id bigint primary key,
             lat integer not null,
             lon integer not null)""")
+        self.cur.execute(f"""create table {TABLE_RULES} (
+            typ text, tag text, kind text)""")
+
+    def add_geometry_columns(self):
+        """Upgrades a table of watched objects made before geometry was stored."""
+        self.cur.execute(f"""alter table {TABLE_OBJECTS}
+            add column if not exists minlat double precision,
+            add column if not exists minlon double precision,
+            add column if not exists maxlat double precision,
+            add column if not exists maxlon double precision,
+            add column if not exists length integer,
+            add column if not exists region text""")
+        self.create_nodes_index()
+        self.conn.commit()
+
+    def create_nodes_index(self):
+        """For finding ways by their nodes, see invalidate_geometry()."""
+        self.cur.execute(f"""create index if not exists idx_{TABLE_OBJECTS}_nodes
+            on {TABLE_OBJECTS} using gin (string_to_array(nodes, ','))""")
+
+    def invalidate_geometry(self, locations):
+        """
+        Receives a dict of node_id -> (lat, lon) from a diff. For stored nodes that moved,
+        updates their locations, and clears bounds, length and region of these nodes
+        and of ways that use them, so that these are measured from node locations again.
+        Returns the number of moved nodes.
+        """
+        moved = []
+        node_ids = list(locations)
+        for i in range(0, len(node_ids), 10000):
+            stored = self.get_locations(node_ids[i:i+10000])
+            for node_id, coord in stored.items():
+                new = locations[node_id]
+                if any(round(coord[j] * COORD_MULTIPLIER) != round(new[j] * COORD_MULTIPLIER)
+                       for j in (0, 1)):
+                    moved.append((node_id, new[0], new[1]))
+        if not moved:
+            return 0
+        self.update_locations(moved)
+        ids = [m[0] for m in moved]
+        self.cur.execute(
+            f"""update {TABLE_OBJECTS} set minlat = null, minlon = null,
+            maxlat = null, maxlon = null, length = null, region = null
+            where string_to_array(nodes, ',') && %s::text[] or osm_id = any(%s)""",
+            (ids, [f'n{i}' for i in ids]))
+        metrics.count('db_queries')
+        metrics.count('geometry_invalidated', self.cur.rowcount)
+        return len(moved)
+
+    def read_rules(self):
+        """Returns tag filter rules recorded at init, or None if the database predates that."""
+        self.cur.execute("select to_regclass(%s)", (TABLE_RULES,))
+        if self.cur.fetchone()[0] is None:
+            return None
+        self.cur.execute(f"select typ, tag, kind from {TABLE_RULES}")
+        return set(self.cur.fetchall())
+
+    def save_rules(self, rules):
+        """Records rules of the tag filter the watched objects were loaded with."""
+        from psycopg2.extras import execute_values
+        self.cur.execute(f"""create table if not exists {TABLE_RULES} (
+            typ text, tag text, kind text)""")
+        self.cur.execute(f"delete from {TABLE_RULES}")
+        if rules:
+            execute_values(self.cur, f"insert into {TABLE_RULES} (typ, tag, kind) values %s",
+                           sorted(rules))
 
     def read_object(self, typ, osm_id):
         self.cur.execute(
-            f"select version, tags, nodes from {TABLE_OBJECTS} where osm_id = %s",
+            f"""select version, tags, nodes, minlat, minlon, maxlat, maxlon, length, region
+            from {TABLE_OBJECTS} where osm_id = %s""",
             (f'{typ[0]}{osm_id}',))
         row = self.cur.fetchone()
+        metrics.count('db_queries')
         if not row:
             return None
-        return StoredObject(typ, osm_id, row[0], row[1], row[2])
+        metrics.count('db_rows_read')
+        return StoredObject(typ, osm_id, row[0], row[1], row[2], row[3:7], row[7], row[8])
 
-    def save_object(self, obj):
+    def save_object(self, obj, overwrite=True):
+        """With overwrite=False, keeps the stored object if there is one."""
         tags = obj.tags  # if not self.tag_filter else self.tag_filter.filter_relevant(obj.tags)
         # Not filtering out non-relevant tags since we rely on them when assessing full tags
+        bounds = obj.bounds or (None, None, None, None)
+        on_conflict = 'do nothing' if not overwrite else """do update set tags = EXCLUDED.tags,
+            version = EXCLUDED.version, nodes = EXCLUDED.nodes,
+            minlat = EXCLUDED.minlat, minlon = EXCLUDED.minlon,
+            maxlat = EXCLUDED.maxlat, maxlon = EXCLUDED.maxlon,
+            length = EXCLUDED.length, region = EXCLUDED.region"""
         self.cur.execute(
             f"""insert into {TABLE_OBJECTS}
-            (osm_id, version, tags, nodes) values (%s, %s, %s, %s)
-            on conflict (osm_id) do update set tags = EXCLUDED.tags,
-            version = EXCLUDED.version, nodes = EXCLUDED.nodes""",
-            (obj.db_id, obj.version, json.dumps(tags), obj.nodes_str)
+            (osm_id, version, tags, nodes, minlat, minlon, maxlat, maxlon, length, region)
+            values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            on conflict (osm_id) {on_conflict}""",
+            (obj.db_id, obj.version, json.dumps(tags), obj.nodes_str,
+             *bounds, obj.length, obj.region)
         )
+        metrics.count('db_queries')
+        metrics.count('db_rows_written')
 
-    def update_locations(self, nodes):
-        """nodes is a list of (node_id, lat, lon)."""
+    def update_locations(self, nodes, overwrite=True):
+        """nodes is a list of (node_id, lat, lon). With overwrite=False, keeps stored ones."""
+        from psycopg2.extras import execute_values
         if not nodes:
             return
         # Deduplicate nodes
         node_dict = {n[0]: (n[1], n[2]) for n in nodes}
+        on_conflict = ('do nothing' if not overwrite
+                       else 'do update set lat = EXCLUDED.lat, lon = EXCLUDED.lon')
         execute_values(
             self.cur, f"""insert into {TABLE_LOCATIONS} (node_id, lat, lon) values %s
-            on conflict (node_id) do update set lat = EXCLUDED.lat, lon = EXCLUDED.lon""",
+            on conflict (node_id) {on_conflict}""",
             [(int(node_id), round(coord[0] * COORD_MULTIPLIER),
               round(coord[1] * COORD_MULTIPLIER)) for node_id, coord in node_dict.items()]
         )
+        metrics.count('db_queries')
+        metrics.count('db_rows_written', len(node_dict))
 
     def get_locations(self, node_ids):
         """Returns dict of node_id -> (lat, lon)."""
@@ -97,4 +207,39 @@ class OscDatabase:
         coords = {}
         for row in self.cur:
             coords[str(row[0])] = (row[1] / COORD_MULTIPLIER, row[2] / COORD_MULTIPLIER)
+        metrics.count('db_queries')
+        metrics.count('db_rows_read', len(coords))
+        return coords
+
+
+class BufferedOscDatabase(OscDatabase):
+    """
+    Reads from the database, but keeps all changes in memory,
+    so that they can be applied later in a single transaction.
+    """
+    def __init__(self, conn, tag_filter=None):
+        super().__init__(conn, tag_filter)
+        self.clear()
+
+    def clear(self):
+        self.objects = {}  # db_id -> StoredObject
+        self.locations = {}  # node_id -> (lat, lon)
+
+    def read_object(self, typ, osm_id):
+        db_id = f'{typ[0]}{osm_id}'
+        if db_id in self.objects:
+            return self.objects[db_id]
+        return super().read_object(typ, osm_id)
+
+    def save_object(self, obj):
+        self.objects[obj.db_id] = obj
+
+    def update_locations(self, nodes):
+        for node_id, lat, lon in nodes:
+            self.locations[str(node_id)] = (lat, lon)
+
+    def get_locations(self, node_ids):
+        coords = {k: self.locations[k] for k in node_ids if k in self.locations}
+        if len(coords) < len(node_ids):
+            coords.update(super().get_locations(set(node_ids) - coords.keys()))
         return coords
@@ -1,24 +1,51 @@
 import argparse
-import psycopg2
 import osmium
-import requests
 import logging
-import gzip
 import itertools
+import multiprocessing
+import multiprocessing.util
+from functools import lru_cache
 from lxml import etree
-from osc_db import OscDatabase, StoredObject
-from filters import TagFilter, RegionFilter
+from osc_db import OscDatabase, BufferedOscDatabase, StoredObject, FULL_TYPES
+from filters import TagFilter, RegionFilter, read_contests, union_filters
+from metrics import metrics, add_metrics_arguments, write_metrics
+from profiling import add_profiling_arguments, start_profiling
+from change_records import RecordWriter
 
 
 OSM_API = 'https://api.openstreetmap.org/api/0.6'
 
 
+@lru_cache()
+def get_geod():
+    from pyproj import Geod
+    return Geod(ellps='WGS84')
+
+
+def way_length(lons, lats) -> int:
+    """Geodesic length in meters, rounded like in adiff_to_csv."""
+    return round(get_geod().line_length(lons, lats))
+
+
 class InitHandler(osmium.SimpleHandler):
-    def __init__(self, db, tag_filter, region_filter):
+    # When adding to tables in use, commit often to not hold locks for replication
+    UPDATE_COMMIT_EVERY = 10000
+
+    def __init__(self, db, tag_filter, region_filter, overwrite=True):
         super().__init__()
         self.db = db
         self.tag_filter = tag_filter
         self.region_filter = region_filter
+        # With overwrite=False, objects and locations already stored are kept as they are
+        self.overwrite = overwrite
+        self.saved = 0
+
+    def save(self, obj, locations):
+        self.db.save_object(obj, self.overwrite)
+        self.db.update_locations(locations, self.overwrite)
+        self.saved += 1
+        if not self.overwrite and self.saved % self.UPDATE_COMMIT_EVERY == 0:
+            self.db.conn.commit()
 
     def tags_to_dict(self, obj):
         return {tag.k: tag.v for tag in obj.tags}
@@ -27,12 +54,14 @@ class InitHandler(osmium.SimpleHandler):
         tags = self.tags_to_dict(n)
         if not self.tag_filter.is_empty and not self.tag_filter.get_kinds('node', tags):
             return
-        if (not self.region_filter.is_empty and
-                not self.region_filter.find(n.location.lon, n.location.lat)):
+        lat, lon = n.location.lat, n.location.lon
+        region = self.region_filter.find(lon, lat)
+        if not self.region_filter.is_empty and not region:
             return
-        self.db.save_object(StoredObject('node', n.id, n.version, tags))
-        # Save its location
-        self.db.update_locations([(n.id, n.location.lat, n.location.lon)])
+        # Save it with its location
+        self.save(StoredObject(
+            'node', n.id, n.version, tags, bounds=(lat, lon, lat, lon), region=region),
+            [(n.id, lat, lon)])
 
     def way(self, w):
         if len(w.nodes) < 2:
@@ -40,11 +69,91 @@ class InitHandler(osmium.SimpleHandler):
         tags = self.tags_to_dict(w)
         if not self.tag_filter.is_empty and not self.tag_filter.get_kinds('way', tags):
             return
-        self.db.save_object(StoredObject(
-            'way', w.id, w.version, tags, [n.ref for n in w.nodes]
-        ))
+        lats = [n.location.lat for n in w.nodes]
+        lons = [n.location.lon for n in w.nodes]
+        bounds = (min(lats), min(lons), max(lats), max(lons))
         # Also store node locations
-        self.db.update_locations([(n.ref, n.location.lat, n.location.lon) for n in w.nodes])
+        self.save(StoredObject(
+            'way', w.id, w.version, tags, [n.ref for n in w.nodes],
+            bounds, way_length(lons, lats),
+            self.region_filter.find((bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2)
+        ), [(n.ref, n.location.lat, n.location.lon) for n in w.nodes])
+
+
+class OscObject:
+    """An object from an osmChange file, copied out of the osmium buffer."""
+    __slots__ = ('action', 'typ', 'osm_id', 'version', 'attrs', 'tags',
+                 'lat', 'lon', 'nodes', 'members')
+
+    def __init__(self, typ, obj):
+        if obj.deleted:
+            self.action = 'delete'
+        else:
+            # osmium does not tell create from modify, but only new objects have version 1
+            self.action = 'create' if obj.version == 1 else 'modify'
+        self.typ = typ
+        self.osm_id = str(obj.id)
+        self.version = str(obj.version)
+        self.attrs = {
+            'id': self.osm_id,
+            'version': self.version,
+            'timestamp': obj.timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'uid': str(obj.uid),
+            'user': obj.user,
+            'changeset': str(obj.changeset),
+        }
+        self.tags = {tag.k: tag.v for tag in obj.tags}
+        self.lat = self.lon = None
+        self.nodes = None
+        self.members = None
+        if typ == 'node':
+            if obj.location.valid():
+                self.lat = obj.location.lat
+                self.lon = obj.location.lon
+                self.attrs['lat'] = f'{self.lat:.7f}'
+                self.attrs['lon'] = f'{self.lon:.7f}'
+        elif typ == 'way':
+            self.nodes = [str(n.ref) for n in obj.nodes]
+        else:
+            self.members = [(FULL_TYPES[m.type], str(m.ref), m.role) for m in obj.members]
+
+    @property
+    def node_ids(self):
+        if self.typ == 'way':
+            return self.nodes
+        if self.typ == 'relation':
+            return [m[1] for m in self.members if m[0] == 'node']
+        return None
+
+
+class OscReader(osmium.SimpleHandler):
+    """Reads an osmChange file and passes every object as OscObject to a callback."""
+    def __init__(self, callback, ways_only=False):
+        super().__init__()
+        self.callback = callback
+        self.ways_only = ways_only
+
+    def node(self, n):
+        if not self.ways_only:
+            self.callback(OscObject('node', n))
+
+    def way(self, w):
+        self.callback(OscObject('way', w))
+
+    def relation(self, r):
+        if not self.ways_only:
+            self.callback(OscObject('relation', r))
+
+
+class OscLocationHandler(osmium.SimpleHandler):
+    """Collects node locations from an osmChange file."""
+    def __init__(self):
+        super().__init__()
+        self.locations = {}  # node_id -> (lat, lon)
+
+    def node(self, n):
+        if n.location.valid():
+            self.locations[str(n.id)] = (n.location.lat, n.location.lon)
 
 
 class Bounds:
@@ -81,39 +190,33 @@ class AdiffBuilder:
         self.db = db
         self.tag_filter = tag_filter
         self.region_filter = region_filter
+        # (type, id, version) -> element, for old versions downloaded beforehand
+        self.old_versions = {}
 
-    def scan_node_locations(self, fileobj) -> dict:
+    def scan_node_locations(self, filename) -> dict:
         """Searches for nodes and returns dict of node_id -> (lat, lon)."""
-        locs = {}
-        for _, action in etree.iterparse(fileobj, events=['end'],
-                                         tag=['create', 'modify', 'delete']):
-            for node in action.findall('node'):
-                node_id = node.get('id')
-                if node.get('lat'):
-                    locs[node_id] = float(node.get('lat')), float(node.get('lon'))
-            action.clear()
-        fileobj.seek(0)
-        return locs
-
-    def scan_relevant_ways_nodes(self, fileobj, locations) -> set:
+        handler = OscLocationHandler()
+        handler.apply_file(filename)
+        return handler.locations
+
+    def scan_relevant_ways_nodes(self, filename, locations) -> set:
         """Looks for ways with no nodes in the database or in osc, and adds these to locations."""
         if self.region_filter.is_empty:
             return
         node_ids = set()
-        for _, action in etree.iterparse(fileobj, events=['end'],
-                                         tag=['create', 'modify', 'delete']):
-            for way in action.findall('way'):
-                if not self.wrong_tags(way):
-                    point = self.get_representative_point(way, locations)
-                    if not point:
-                        ids = self.get_node_ids(way)
-                        if ids and node_ids.isdisjoint(set(ids)):
-                            node_ids.add(ids[0])
-            action.clear()
+
+        def check_way(way):
+            if not self.wrong_tags(way):
+                point = self.get_representative_point(way, locations)
+                if not point:
+                    ids = way.node_ids
+                    if ids and node_ids.isdisjoint(set(ids)):
+                        node_ids.add(ids[0])
+
+        OscReader(check_way, ways_only=True).apply_file(filename)
         # Now download nodes from OSM API
         loc = self.download_node_locations(node_ids)
         locations.update(loc)
-        fileobj.seek(0)
 
     def get_node_ids(self, obj):
         if obj.tag == 'way':
@@ -123,17 +226,17 @@ class AdiffBuilder:
         return None
 
     def get_representative_point(self, obj, locations, download=False) -> tuple:
-        """Returns (lat, lon) for an xml object of way or node."""
-        if obj.tag == 'node':
-            if obj.get('lat'):
-                return float(obj.get('lat')), float(obj.get('lon'))
+        """Returns (lat, lon) for an osmChange object of way or node."""
+        if obj.typ == 'node':
+            if obj.lat is not None:
+                return obj.lat, obj.lon
             # Deleted node, look up coordinates in the database
-            node_ids = [obj.get('id')]
+            node_ids = [obj.osm_id]
         else:
-            node_ids = set(self.get_node_ids(obj))
+            node_ids = set(obj.node_ids)
             if not node_ids:
                 # Deleted way/relation, get nodes from the database
-                old = self.db.read_object(obj.tag, obj.get('id'))
+                old = self.db.read_object(obj.typ, obj.osm_id)
                 if old and old.nodes:
                     node_ids = set(old.nodes)
         if not node_ids:
@@ -141,20 +244,30 @@ class AdiffBuilder:
 
         # First look up nodes in the same osmChange
         loc = {k: locations[k] for k in node_ids if k in locations}
-        if not loc:
+        if loc:
+            metrics.count('point_from_osc')
+        else:
             # Not found, e.g. just a tag change. Look up in the database
             loc = self.db.get_locations(node_ids)
+            if loc:
+                metrics.count('point_from_db')
         if not loc and download:
             loc = self.download_node_locations(list(node_ids)[:1])
+            metrics.count('point_from_api')
         return None if not loc else loc[list(loc.keys())[0]]
 
     def get_locations_from_everywhere(self, node_ids, locations=None):
         id_set = set(node_ids)
         loc = {} if not locations else {k: locations[k] for k in id_set if k in locations}
+        metrics.count('locations_from_osc', len(loc))
         if len(loc) < len(id_set):
-            loc.update(self.db.get_locations(id_set - loc.keys()))
+            found = self.db.get_locations(id_set - loc.keys())
+            metrics.count('locations_from_db', len(found))
+            loc.update(found)
         if len(loc) < len(id_set):
-            loc.update(self.download_node_locations(id_set - loc.keys()))
+            found = self.download_node_locations(id_set - loc.keys())
+            metrics.count('locations_from_api', len(found))
+            loc.update(found)
         return loc
 
     def add_locations(self, obj, locations=None):
@@ -194,27 +307,20 @@ class AdiffBuilder:
             logging.debug('No bounds to add to %s %s', obj.tag, obj.get('id'))
 
     def copy_with_locations(self, parent, obj, locations):
-        new = etree.SubElement(parent, obj.tag)
-        for k, v in obj.items():
-            new.set(k, v)
-        for tag in obj.findall('tag'):
-            tag_node = etree.SubElement(new, 'tag')
-            tag_node.set('k', tag.get('k'))
-            tag_node.set('v', tag.get('v'))
+        new = etree.SubElement(parent, obj.typ, obj.attrs)
+        for k, v in obj.tags.items():
+            etree.SubElement(new, 'tag', k=k, v=v)
 
-        if obj.tag == 'way':
+        if obj.typ == 'way':
             # Copy nodes
-            for child in obj.findall('nd'):
-                etree.SubElement(new, 'nd', ref=child.get('ref'))
+            for ref in obj.nodes:
+                etree.SubElement(new, 'nd', ref=ref)
 
-        if obj.tag == 'relation':
+        if obj.typ == 'relation':
             # Copy members
-            for child in obj.findall('member'):
-                etree.SubElement(
-                    new, 'member', type=child.get('type'),
-                    ref=child.get('ref'), role=child.get('role')
-                )
-        if obj.tag != 'node':
+            for typ, ref, role in obj.members:
+                etree.SubElement(new, 'member', type=typ, ref=ref, role=role)
+        if obj.typ != 'node':
             self.add_locations(new, locations)
         return new
 
@@ -234,6 +340,13 @@ class AdiffBuilder:
             parent, stored.typ,
             id=str(stored.osm_id), version=str(stored.version)
         )
+        if stored.has_geometry:
+            if stored.typ == 'node':
+                obj.set('lat', str(stored.bounds[0]))
+                obj.set('lon', str(stored.bounds[1]))
+            elif stored.length is not None:
+                # Not in the augmented diff format, used instead of node locations
+                obj.set('length', str(stored.length))
         for k, v in stored.tags.items():
             etree.SubElement(obj, 'tag', k=k, v=v)
         if stored.nodes:
@@ -242,16 +355,90 @@ class AdiffBuilder:
                     etree.SubElement(obj, 'nd', ref=node_id)
                 else:
                     etree.SubElement(obj, 'member', ref=node_id, type='node', role='')
+        if stored.has_geometry and stored.typ != 'node':
+            etree.SubElement(obj, 'bounds', dict(zip(
+                ('minlat', 'minlon', 'maxlat', 'maxlon'), (str(b) for b in stored.bounds))))
         return obj
 
+    def invalidate_geometry(self, locations):
+        """Stored geometry of objects with moved nodes is out of date, so it is cleared."""
+        with metrics.stage('invalidate_geometry'):
+            moved = self.db.invalidate_geometry(locations)
+        logging.info('%s watched nodes moved', moved)
+
+    def get_geometry(self, obj):
+        """For an object element with locations, returns bounds, length and region."""
+        if obj.tag == 'node':
+            if not obj.get('lat'):
+                return None, None, None
+            lat, lon = float(obj.get('lat')), float(obj.get('lon'))
+            bounds = (lat, lon, lat, lon)
+        else:
+            b = obj.find('bounds')
+            if b is None:
+                return None, None, None
+            bounds = tuple(float(b.get(k)) for k in ('minlat', 'minlon', 'maxlat', 'maxlon'))
+        length = None
+        if obj.tag == 'way':
+            nodes = obj.findall('nd')
+            if len(nodes) >= 2 and all(nd.get('lat') for nd in nodes):
+                length = way_length([float(nd.get('lon')) for nd in nodes],
+                                    [float(nd.get('lat')) for nd in nodes])
+        region = self.region_filter.find((bounds[1] + bounds[3]) / 2,
+                                         (bounds[0] + bounds[2]) / 2)
+        return bounds, length, region
+
+    def api_get(self, url, params=None):
+        import requests
+        resp = requests.get(url, params)
+        metrics.count('api_calls')
+        metrics.count('api_bytes', len(resp.content))
+        return resp
+
     def download_version(self, osm_type, osm_id, version):
-        resp = requests.get(f'{OSM_API}/{osm_type}/{osm_id}/{version}')
+        resp = self.api_get(f'{OSM_API}/{osm_type}/{osm_id}/{version}')
         logging.debug('Queried OSM API for %s %s v%s, status code %s',
                       osm_type, osm_id, version, resp.status_code)
         if resp.status_code != 200:
             raise IOError(f'Could not download version {osm_type}/{osm_id}/{version}')
         return etree.fromstring(resp.content)[0]
 
+    def needs_old_version(self, obj, locations) -> bool:
+        """Checks whether process_object would have to download the previous version."""
+        if obj.action != 'modify' or self.wrong_tags(obj):
+            return False
+        if not self.region_filter.is_empty:
+            point = self.get_representative_point(obj, locations)
+            if point and not self.region_filter.find(point[1], point[0]):
+                return False
+        return self.db.read_object(obj.typ, obj.osm_id) is None
+
+    def download_versions(self, versions):
+        """
+        Downloads old versions, a list of (type, id, version), in a few requests
+        per object type, and keeps these for get_old_version.
+        """
+        by_type = {}
+        for typ, osm_id, version in versions:
+            by_type.setdefault(typ, []).append(f'{osm_id}v{version}')
+        for typ, refs in by_type.items():
+            for chunk in self.iter_chunks(refs, 300):
+                resp = self.api_get(f'{OSM_API}/{typ}s', {f'{typ}s': ','.join(chunk)})
+                logging.debug('Requested %s old versions of %ss, status code %s',
+                              len(chunk), typ, resp.status_code)
+                if resp.status_code != 200:
+                    # Some version is missing or redacted, these will be downloaded one by one
+                    continue
+                for obj in etree.fromstring(resp.content):
+                    self.old_versions[(obj.tag, obj.get('id'), int(obj.get('version')))] = obj
+        metrics.count('old_versions_prefetched', len(self.old_versions))
+
+    def get_old_version(self, osm_type, osm_id, version):
+        old = self.old_versions.pop((osm_type, str(osm_id), version), None)
+        if old is None:
+            old = self.download_version(osm_type, osm_id, version)
+        return old
+
     def iter_chunks(self, iterable, count):
         it = iter(iterable)
         while True:
@@ -269,7 +456,7 @@ class AdiffBuilder:
             return {}
         loc = {}
         for chunk in self.iter_chunks(node_ids, 500):
-            resp = requests.get(f'{OSM_API}/nodes', {'nodes': ",".join(chunk)})
+            resp = self.api_get(f'{OSM_API}/nodes', {'nodes': ",".join(chunk)})
             logging.debug('Requesting nodes from OSM API: %s. Status code %s',
                           ', '.join(chunk), resp.status_code)
             if resp.status_code != 200:
@@ -282,7 +469,7 @@ class AdiffBuilder:
         # Now we need to test for deleted nodes
         for node_id in node_ids:
             if str(node_id) not in loc:
-                resp = requests.get(f'{OSM_API}/node/{node_id}/history')
+                resp = self.api_get(f'{OSM_API}/node/{node_id}/history')
                 logging.debug('Requested node %s history, status code %s',
                               node_id, resp.status_code)
                 if resp.status_code != 200:
@@ -296,130 +483,271 @@ class AdiffBuilder:
 
     def wrong_tags(self, obj, tags=None):
         if tags is None:
-            tags = {t.get('k'): t.get('v') for t in obj.findall('tag')}
-        return not self.tag_filter.is_empty and not self.tag_filter.get_kinds(obj.tag, tags)
-
-    def process_osc(self, filename, adiff):
+            tags = obj.tags
+        return not self.tag_filter.is_empty and not self.tag_filter.get_kinds(obj.typ, tags)
+
+    def process_object(self, obj, root, locations):
+        """Decides what to do with an osmChange object, and adds an action to root."""
+        obj_desc = f'Action {obj.action} {obj.typ} {obj.osm_id} v{obj.version}'
+        tags = obj.tags
+        # Deleted objects have no locations, so their old versions are needed for regions
+        old = self.db.read_object(obj.typ, obj.osm_id) if obj.action == 'delete' else None
+        if not self.region_filter.is_empty:
+            if obj.action == 'delete' and old and old.has_geometry:
+                point = old.centroid
+                inside = old.region or self.region_filter.find(point[1], point[0])
+            else:
+                # If tags are right, download a representative node from OSM API
+                point = self.get_representative_point(
+                    obj, locations, not self.wrong_tags(obj, tags))
+                inside = point and self.region_filter.find(point[1], point[0])
+            if not inside:
+                # No coords or coord is not in a region
+                coord_str = '(null)' if not point else f'({point[1]}, {point[0]})'
+                logging.debug('%s: %s outside of regions', obj_desc, coord_str)
+                metrics.count('dropped_region')
+                return
+        if obj.action == 'create':
+            # No tag history, just check what we have
+            if self.wrong_tags(obj, tags):
+                logging.debug('%s: no relevant tags', obj_desc)
+                metrics.count('dropped_tags')
+                return
+            # Simply copy as-is, adding locations to way nodes
+            na = etree.SubElement(root, 'action', type='create')
+            new = self.copy_with_locations(na, obj, locations)
+            # Store locations to db
+            self.store_locations(new)
+            # Add object to our database to monitor its changes
+            self.db.save_object(StoredObject(
+                obj.typ, obj.osm_id, obj.version, tags, obj.node_ids,
+                *self.get_geometry(new)
+            ))
+        else:
+            if obj.action != 'delete':
+                old = self.db.read_object(obj.typ, obj.osm_id)
+            if not old and self.wrong_tags(obj, tags):
+                # Skipping if there is no history (meaning no relevant tags in old versions)
+                # and no relevant tags in the new version.
+                logging.debug('%s: no history and no relevant tags', obj_desc)
+                metrics.count('dropped_tags')
+                return
+            if obj.action == 'delete' and not old:
+                # Skip deletions of things we don't have history on
+                logging.debug('%s: no history, meaning no relevant tags', obj_desc)
+                metrics.count('dropped_no_history')
+                return
+            na = etree.SubElement(root, 'action', type=obj.action)
+            na_old = etree.SubElement(na, 'old')
+            na_new = etree.SubElement(na, 'new')
+            if obj.action == 'delete':
+                # Restore old version
+                self.stored_to_xml(na_old, old)
+                if not old.has_geometry:
+                    # Add locations to old nodes and save them to db if needed
+                    # Not passing locations to use stored ones.
+                    self.add_locations(na_old[0])
+                # self.store_locations(na_old[0])  # not sure this is needed
+                # Note that even for ways there are no tags and no referenced nodes
+                self.copy_with_locations(na_new, obj, locations)
+                # Register deletion as zero tags to our database
+                self.db.save_object(StoredObject(
+                    obj.typ, obj.osm_id, obj.version, {}
+                ))
+            elif obj.action == 'modify':
+                # First copy new version with locations
+                new = self.copy_with_locations(na_new, obj, locations)
+                # Store locations to db
+                self.store_locations(new)
+                # Restore or download old version
+                if old:
+                    self.stored_to_xml(na_old, old)
+                    if not old.has_geometry:
+                        # Again, no current locations to use stored ones.
+                        self.add_locations(na_old[0])
+                else:
+                    old = self.get_old_version(
+                        obj.typ, obj.osm_id, int(obj.version) - 1)
+                    if old is not None:
+                        na_old.append(old)
+                        self.add_locations(na_old[0], locations)
+                self.db.save_object(StoredObject(
+                    obj.typ, obj.osm_id, obj.version, tags, obj.node_ids,
+                    *self.get_geometry(new)
+                ))
+            else:
+                raise ValueError(f'Unknown osc action: {obj.action}')
+        logging.debug('%s: written to augmented diff', obj_desc)
+        metrics.count(f'kept_{obj.action}')
+
+    def write_output(self, root, adiff=None, records=None):
+        """Writes actions to an augmented diff and/or a change records file."""
+        if adiff:
+            tree = etree.ElementTree(root)
+            tree.write(adiff, pretty_print=True, encoding='utf-8')
+        if records:
+            writer = RecordWriter(records)
+            for action in root:
+                writer.write_action(action)
+            writer.close()
+
+    def process_osc(self, filename, adiff, records=None):
         logging.info('Reading osmChange file %s', filename)
         logging.info('Scanning for node locations')
-        fileobj = gzip.open(filename)
-        locations = self.scan_node_locations(fileobj)
+        with metrics.stage('scan_locations'):
+            locations = self.scan_node_locations(filename)
+        metrics.count('osc_node_locations', len(locations))
+        self.invalidate_geometry(locations)
         if not self.region_filter.is_empty:
             logging.info('Downloading missing node locations')
-            self.scan_relevant_ways_nodes(fileobj, locations)
+            with metrics.stage('scan_ways'):
+                self.scan_relevant_ways_nodes(filename, locations)
+        logging.info('Downloading missing old versions')
+        with metrics.stage('old_versions'):
+            missing = []
+
+            def check_object(obj):
+                if self.needs_old_version(obj, locations):
+                    missing.append((obj.typ, obj.osm_id, int(obj.version) - 1))
+
+            OscReader(check_object).apply_file(filename)
+            self.download_versions(missing)
         logging.info('Iterating over actions')
         root = etree.Element('osm', version='0.6', generator='OSC to ADIFF')
-        for _, action in etree.iterparse(fileobj, events=['end'],
-                                         tag=['create', 'modify', 'delete']):
-            for obj in action:
-                obj_desc = f'Action {action.tag} {obj.tag} {obj.get("id")} v{obj.get("version")}'
-                tags = {t.get('k'): t.get('v') for t in obj.findall('tag')}
-                if not self.region_filter.is_empty:
-                    # If tags are right, download a representative node from OSM API
-                    point = self.get_representative_point(
-                        obj, locations, not self.wrong_tags(obj, tags))
-                    if not point or not self.region_filter.find(point[1], point[0]):
-                        # No coords or coord is not in a region
-                        coord_str = '(null)' if not point else f'({point[1]}, {point[0]})'
-                        logging.debug('%s: %s outside of regions', obj_desc, coord_str)
-                        obj.clear()
-                        continue
-                if action.tag == 'create':
-                    # No tag history, just check what we have
-                    if self.wrong_tags(obj, tags):
-                        logging.debug('%s: no relevant tags', obj_desc)
-                        obj.clear()
-                        continue
-                    # Simply copy as-is, adding locations to way nodes
-                    na = etree.SubElement(root, 'action', type='create')
-                    new = self.copy_with_locations(na, obj, locations)
-                    # Store locations to db
-                    self.store_locations(new)
-                    # Add object to our database to monitor its changes
-                    self.db.save_object(StoredObject(
-                        obj.tag, obj.get('id'), obj.get('version'), tags,
-                        self.get_node_ids(obj)
-                    ))
-                else:
-                    old = db.read_object(obj.tag, obj.get('id'))
-                    if not old and self.wrong_tags(obj, tags):
-                        # Skipping if there is no history (meaning no relevant tags in old versions)
-                        # and no relevant tags in the new version.
-                        logging.debug('%s: no history and no relevant tags', obj_desc)
-                        obj.clear()
-                        continue
-                    if action.tag == 'delete' and not old:
-                        # Skip deletions of things we don't have history on
-                        logging.debug('%s: no history, meaning no relevant tags', obj_desc)
-                        obj.clear()
-                        continue
-                    na = etree.SubElement(root, 'action', type=action.tag)
-                    na_old = etree.SubElement(na, 'old')
-                    na_new = etree.SubElement(na, 'new')
-                    if action.tag == 'delete':
-                        # Restore old version
-                        self.stored_to_xml(na_old, old)
-                        # Add locations to old nodes and save them to db if needed
-                        # Not passing locations to use stored ones.
-                        self.add_locations(na_old[0])
-                        # self.store_locations(na_old[0])  # not sure this is needed
-                        # Note that even for ways there are no tags and no referenced nodes
-                        self.copy_with_locations(na_new, obj, locations)
-                        # Register deletion as zero tags to our database
-                        self.db.save_object(StoredObject(
-                            obj.tag, obj.get('id'), obj.get('version'), {}
-                        ))
-                    elif action.tag == 'modify':
-                        # First copy new version with locations
-                        new = self.copy_with_locations(na_new, obj, locations)
-                        # Store locations to db
-                        self.store_locations(new)
-                        # Restore or download old version
-                        if old:
-                            self.stored_to_xml(na_old, old)
-                            # Again, no current locations to use stored ones.
-                            self.add_locations(na_old[0])
-                        else:
-                            old = self.download_version(
-                                obj.tag, obj.get('id'), int(obj.get('version')) - 1)
-                            if old is not None:
-                                na_old.append(old)
-                                self.add_locations(na_old[0], locations)
-                        self.db.save_object(StoredObject(
-                            obj.tag, obj.get('id'), obj.get('version'), tags,
-                            self.get_node_ids(obj)
-                        ))
-                    else:
-                        raise ValueError(f'Unknown osc action: {action.tag}')
-                logging.debug('%s: written to augmented diff', obj_desc)
-                obj.clear()
-            action.clear()
-        fileobj.close()
+        reader = OscReader(lambda obj: self.process_object(obj, root, locations))
+        with metrics.stage('actions'):
+            reader.apply_file(filename)
         logging.info('Done, writing the augmented diff')
-        tree = etree.ElementTree(root)
-        tree.write(adiff, pretty_print=True, encoding='utf-8')
+        with metrics.stage('write_adiff'):
+            self.write_output(root, adiff, records)
 
+    def process_osc_parallel(self, filename, adiff, jobs, connect, records=None):
+        """
+        Like process_osc, but objects are split between worker processes by id.
+        Each worker has its own database connection, and sends back actions
+        and database changes, which we apply here in one transaction.
+        """
+        logging.info('Reading osmChange file %s', filename)
+        with metrics.stage('scan_locations'):
+            objects = []
+            OscReader(objects.append).apply_file(filename)
+            locations = {o.osm_id: (o.lat, o.lon) for o in objects
+                         if o.typ == 'node' and o.lat is not None}
+        metrics.count('osc_node_locations', len(locations))
+        self.invalidate_geometry(locations)
+        # Workers use their own connections, and must see cleared geometry
+        self.db.conn.commit()
+        if not self.region_filter.is_empty:
+            logging.info('Downloading missing node locations')
+            with metrics.stage('scan_ways'):
+                self.scan_relevant_ways_nodes(filename, locations)
+        logging.info('Downloading missing old versions')
+        with metrics.stage('old_versions'):
+            self.download_versions([(o.typ, o.osm_id, int(o.version) - 1) for o in objects
+                                    if self.needs_old_version(o, locations)])
+
+        logging.info('Processing actions in %s processes', jobs)
+        shards = [[] for _ in range(jobs)]
+        for idx, obj in enumerate(objects):
+            shards[int(obj.osm_id) % jobs].append(idx)
+        # Forked workers get these without pickling
+        _shared.update(objects=objects, locations=locations, connect=connect,
+                       tag_filter=self.tag_filter, region_filter=self.region_filter,
+                       old_versions=self.old_versions)
+        actions = []
+        with metrics.stage('actions'):
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(jobs, _init_worker) as pool:
+                for shard_actions, stored, locs, counters in pool.map(_process_shard, shards):
+                    actions.extend(shard_actions)
+                    for obj in stored:
+                        self.db.save_object(obj)
+                    self.db.update_locations([(k, v[0], v[1]) for k, v in locs.items()])
+                    for k, v in counters.items():
+                        metrics.count(k, v)
+                # Let workers exit normally and close their connections,
+                # "with" would terminate them
+                pool.close()
+                pool.join()
+        _shared.clear()
 
-if __name__ == '__main__':
+        logging.info('Done, writing the augmented diff')
+        with metrics.stage('write_adiff'):
+            root = etree.Element('osm', version='0.6', generator='OSC to ADIFF')
+            # Restoring the original order of actions
+            actions.sort(key=lambda a: a[0])
+            for _, action in actions:
+                root.append(etree.fromstring(action))
+            self.write_output(root, adiff, records)
+
+
+# State for forked workers of AdiffBuilder.process_osc_parallel
+_shared = {}
+
+
+def _init_worker():
+    conn = _shared['connect']()
+    # Called when the worker exits after pool.close()
+    multiprocessing.util.Finalize(None, conn.close, exitpriority=10)
+    db = BufferedOscDatabase(conn, _shared['tag_filter'])
+    _shared['builder'] = AdiffBuilder(db, _shared['tag_filter'], _shared['region_filter'])
+    _shared['builder'].old_versions = _shared['old_versions']
+
+
+def _process_shard(indices):
+    """Processes objects with given indices, returns actions and database changes."""
+    builder = _shared['builder']
+    builder.db.clear()
+    metrics.counters = {}
+    objects = _shared['objects']
+    root = etree.Element('osm')
+    actions = []
+    for idx in indices:
+        before = len(root)
+        builder.process_object(objects[idx], root, _shared['locations'])
+        for action in root[before:]:
+            actions.append((idx, etree.tostring(action)))
+    return actions, list(builder.db.objects.values()), builder.db.locations, metrics.counters
+
+
+def main(argv=None, prog=None, action=None):
     parser = argparse.ArgumentParser(
+        prog=prog,
         description='Converts osmChange to Augmented Diffs based on tag and region filters.')
-    parser.add_argument('action', choices=['init', 'process'])
+    if not action:
+        parser.add_argument('action', choices=['init', 'process'])
     parser.add_argument('input', help='Source file, either a pbf or an osmChange')
     parser.add_argument('-a', '--adiff', type=argparse.FileType('wb'),
                         help='Augmented diff file to produce')
+    parser.add_argument('-b', '--records', type=argparse.FileType('wb'),
+                        help='Also or instead write actions into a compact change records file')
     parser.add_argument('-t', '--tags', type=argparse.FileType('r'),
                         help='File with a list of tags to watch')
     parser.add_argument('-r', '--regions', type=argparse.FileType('r'),
                         help='CSV file with names and wkb geometry for regions to filter')
+    parser.add_argument('-c', '--contests', type=argparse.FileType('r'),
+                        help='File with contests (name, table, tags, regions), '
+                        'replaces -t and -r with their union')
+    parser.add_argument('--update', action='store_true',
+                        help='For init, add objects for tag rules not in the database yet, '
+                        'keeping the tables')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes for processing an osmChange')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Print messages. Specify twice to print debug messages')
+    add_metrics_arguments(parser)
+    add_profiling_arguments(parser)
     psql = parser.add_argument_group('PostgreSQL connection')
     psql.add_argument('-d', '--database', required=True, help='PSQL database name')
     psql.add_argument('-H', '--dbhost', help='PSQL hostname, default is localhost')
     psql.add_argument('-P', '--dbport', type=int, help='PSQL port, default is 5432')
     psql.add_argument('-U', '--dbuser', help='PSQL user')
     psql.add_argument('-W', '--dbpass', help='PSQL password')
-    options = parser.parse_args()
+    options = parser.parse_args(argv)
+    if action:
+        options.action = action
+    if options.update and options.action != 'init':
+        parser.error('--update is only for init')
 
     if not options.verbose:
         log_level = logging.WARNING
@@ -430,25 +758,66 @@ if __name__ == '__main__':
     logging.basicConfig(level=log_level, format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
     logging.getLogger("requests").setLevel(logging.WARNING)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
+    profiler = start_profiling(options)
+    try:
+        import psycopg2
+        conn_args = {
+            'dbname': options.database,
+            'user': options.dbuser,
+            'password': options.dbpass,
+            'host': options.dbhost,
+            'port': options.dbport,
+        }
+        conn = psycopg2.connect(**conn_args)
+        if options.contests:
+            tags, regions = union_filters(read_contests(options.contests))
+        else:
+            tags = TagFilter(options.tags)
+            regions = RegionFilter(options.regions)
+        db = OscDatabase(conn, tags)
+
+        if options.action == 'init' and options.update:
+            db.add_geometry_columns()
+            old_rules = db.read_rules()
+            if old_rules is None:
+                parser.error('Tag rules were not recorded in the database, please run init '
+                             'without --update')
+            if not old_rules:
+                new_filter = None  # Everything was watched already
+            elif tags.is_empty:
+                new_filter = tags
+            else:
+                added = tags.rules() - old_rules
+                new_filter = None if not added else TagFilter.from_rules(added)
+                if added:
+                    logging.info('New tag rules: %s', ', '.join(
+                        f'{typ} {kind} {tag}' for typ, tag, kind in sorted(added)))
+            if new_filter:
+                handler = InitHandler(db, new_filter, regions, overwrite=False)
+                handler.apply_file(options.input, locations=True)
+                logging.info('Found %s objects for new rules', handler.saved)
+            db.save_rules(tags.rules())
+        elif options.action == 'init':
+            db.create_tables()
+            db.save_rules(tags.rules())
+            handler = InitHandler(db, tags, regions)
+            handler.apply_file(options.input, locations=True)
+        elif options.action == 'process':
+            db.add_geometry_columns()
+            a = AdiffBuilder(db, tags, regions)
+            if options.jobs > 1:
+                a.process_osc_parallel(options.input, options.adiff, options.jobs,
+                                       lambda: psycopg2.connect(**conn_args), options.records)
+            else:
+                a.process_osc(options.input, options.adiff, options.records)
+        else:
+            raise ValueError(f'Wrong action: {options.action}')
+        with metrics.stage('commit'):
+            db.close()
+    finally:
+        profiler.stop()
+    write_metrics(options, 'osc_to_adiff', action=options.action, input=options.input)
 
-    conn = psycopg2.connect(
-        dbname=options.database,
-        user=options.dbuser,
-        password=options.dbpass,
-        host=options.dbhost,
-        port=options.dbport,
-    )
-    tags = TagFilter(options.tags)
-    regions = RegionFilter(options.regions)
-    db = OscDatabase(conn, tags)
-
-    if options.action == 'init':
-        db.create_tables()
-        handler = InitHandler(db, tags, regions)
-        handler.apply_file(options.input, locations=True)
-    elif options.action == 'process':
-        a = AdiffBuilder(db, tags, regions)
-        a.process_osc(options.input, options.adiff)
-    else:
-        raise ValueError(f'Wrong action: {options.action}')
-    db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class StackSampler(threading.Thread):
+    """
+    Records the main thread stack every few milliseconds. Much cheaper than
+    cProfile, and the result can be drawn with flamegraph.pl or speedscope.
+    """
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}'
+                             f':{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, filename):
+        """Writes stacks in the "collapsed" format: one stack and a count per line."""
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class Profiler:
+    """Profiles a run with cProfile or stack sampling, if a file name was given."""
+    def __init__(self, filename=None, mode='cprofile', min_seconds=None):
+        self.filename = filename
+        self.mode = mode
+        self.min_seconds = min_seconds
+        self.profiler = None
+        self.started = None
+
+    def start(self):
+        if not self.filename:
+            return
+        self.started = time.time()
+        if self.mode == 'sample':
+            self.profiler = StackSampler()
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        """Stops profiling and writes the result if the run was slow enough."""
+        if not self.profiler:
+            return
+        if self.mode == 'sample':
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+        duration = time.time() - self.started
+        if self.min_seconds and duration < self.min_seconds:
+            return
+        filename = self.filename.replace(
+            '{time}', time.strftime('%Y%m%d_%H%M%S', time.gmtime(self.started)))
+        if self.mode == 'sample':
+            self.profiler.write(filename)
+        else:
+            self.profiler.dump_stats(filename)
+        logging.info('Run took %.1f s, wrote profile to %s', duration, filename)
+        self.profiler = None
+
+
+def add_profiling_arguments(parser):
+    group = parser.add_argument_group('Profiling')
+    group.add_argument('--profile',
+                       help='Write a profile to this file, "{time}" is replaced with '
+                       'the start time')
+    group.add_argument('--profile-mode', choices=['cprofile', 'sample'], default='cprofile',
+                       help='cProfile dump, or collapsed stacks sampled every 5 ms '
+                       'for a flamegraph')
+    group.add_argument('--profile-min-seconds', type=float,
+                       help='Write the profile only if the run took longer than this')
+
+
+def start_profiling(options):
+    profiler = Profiler(options.profile, options.profile_mode, options.profile_min_seconds)
+    profiler.start()
+    return profiler
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Serves the leaderboard over HTTP. Everything is prepared in memory, and
+prepared again only after the tracker timestamp table gets a new sequence.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote
+from generate_user_stats import (
+    Weights, IncrementalStats, read_users, build_shards, prepare_json, count_by_user,
+    drop_user, write_html)
+from tracker_db import add_psql_arguments, connect
+
+
+class CachedFile:
+    def __init__(self, body, content_type):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.body = body
+        self.gzipped = gzip.compress(body)
+        self.content_type = content_type
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def json_file(data):
+    return CachedFile(json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+                      'application/json; charset=utf-8')
+
+
+class Leaderboard:
+    def __init__(self, connect_db, table, ts_table, weights, users, usergroups, interval):
+        # A function returning a new connection, for when the old one is lost
+        self.connect_db = connect_db
+        self.conn = connect_db()
+        self.table = table
+        self.ts_table = ts_table
+        self.weights = weights
+        self.users = users
+        self.usergroups = usergroups
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.files = {}  # path -> CachedFile
+        self.ts = None
+        self.checked = 0
+
+    def read_ts(self):
+        if self.conn.closed:
+            self.conn = self.connect_db()
+        with self.conn.cursor() as cur:
+            cur.execute(f"select max(ts) from {self.ts_table}")
+            ts = cur.fetchone()[0]
+        self.conn.commit()
+        return ts
+
+    def refresh(self):
+        """Checks the timestamp table at most once per interval, and rebuilds files."""
+        if time.monotonic() - self.checked < self.interval:
+            return
+        # While one thread rebuilds, others keep serving the current files
+        if not self.lock.acquire(blocking=not self.files):
+            return
+        try:
+            if time.monotonic() - self.checked < self.interval:
+                return
+            try:
+                ts = self.read_ts()
+                if ts != self.ts or not self.files:
+                    start = time.perf_counter()
+                    self.files = self.build(ts)
+                    self.ts = ts
+                    logging.info('Prepared %s files for sequence %s in %.1f s',
+                                 len(self.files), ts, time.perf_counter() - start)
+            except Exception:
+                # Otherwise the connection stays in the aborted transaction
+                self.rollback()
+                if not self.files:
+                    raise
+                logging.exception('Could not refresh the leaderboard, serving the previous one')
+            self.checked = time.monotonic()
+        finally:
+            self.lock.release()
+
+    def rollback(self):
+        try:
+            self.conn.rollback()
+        except Exception:
+            # The connection is lost, read_ts() makes a new one
+            pass
+
+    def get(self, path):
+        self.refresh()
+        return self.files.get(path)
+
+    def build(self, ts):
+        agg = IncrementalStats(self.conn, self.table, self.weights)
+        agg.update()
+        stats = agg.read()
+        files = {}
+
+        # Page with regions loaded on demand, and the JSON it uses
+        index, tables = build_shards(stats, self.weights, self.users, self.usergroups,
+                                     suffix='.json')
+        index['ts'] = ts
+        files['index.json'] = json_file(index)
+        for filename, table in tables.items():
+            files[filename] = json_file(table)
+        with open(os.path.join(os.path.dirname(__file__), 'user_stats_shards.html')) as f:
+            files['index.html'] = CachedFile(f.read(), 'text/html; charset=utf-8')
+
+        # The single-page table, like in stats.sh
+        output = io.StringIO()
+        write_html(output, stats, self.weights, self.users, self.usergroups)
+        files['table.html'] = CachedFile(output.getvalue(), 'text/html; charset=utf-8')
+
+        # Totals and rows for every region for each user
+        usernames = stats.usernames
+        totals = count_by_user(stats.result)
+        ranked = sorted((uid for uid in totals
+                         if not drop_user(self.users, usernames, uid)),
+                        key=lambda uid: totals[uid]['score'], reverse=True)
+        by_user = {}
+        for row in prepare_json(stats.result):
+            by_user.setdefault(row.pop('uid'), []).append(row)
+        for rank, uid in enumerate(ranked, 1):
+            files[f'user/{uid}.json'] = json_file({
+                'uid': uid,
+                'user': usernames[uid],
+                'rank': rank,
+                'total': totals[uid],
+                'regions': sorted(by_user.get(uid, []), key=lambda r: r['score'],
+                                  reverse=True),
+            })
+        return files
+
+
+def etag_matches(header, etag):
+    """Tells whether an If-None-Match header lists the ETag, comparing weakly as RFC 7232 says."""
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or etag in (t[2:] if t.startswith('W/') else t for t in tags)
+
+
+class LeaderboardHandler(BaseHTTPRequestHandler):
+    board = None
+
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path).lstrip('/') or 'index.html'
+        try:
+            cached = self.board.get(path)
+        except Exception:
+            logging.exception('Could not prepare the leaderboard')
+            self.send_error(500)
+            return
+        if cached is None:
+            self.send_error(404)
+            return
+        if etag_matches(self.headers.get('If-None-Match', ''), cached.etag):
+            self.send_response(304)
+            self.send_header('ETag', cached.etag)
+            self.end_headers()
+            return
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = cached.gzipped if use_gzip else cached.body
+        self.send_response(200)
+        self.send_header('Content-Type', cached.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', cached.etag)
+        # Browsers should check the ETag every time, for standings can change
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s', self.address_string(), format % args)
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Serves the leaderboard from a tracker table over HTTP.')
+    parser.add_argument('-w', '--weights', type=argparse.FileType('r'),
+                        help='Definitions for weights for change types')
+    parser.add_argument('-u', '--users', type=argparse.FileType('r'),
+                        help='CSV file with users and uids, made with form_to_uid.py')
+    parser.add_argument('-p', '--table', default='osc_tracker',
+                        help='Tracker table, default is osc_tracker')
+    parser.add_argument('--ts-table', default='osc_tracker_ts',
+                        help='Table with processed sequences, default is osc_tracker_ts')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port, default is 8000')
+    parser.add_argument('--interval', type=float, default=30,
+                        help='Seconds between checks for a new sequence, default is 30')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Print rebuilds, specify twice to print requests')
+    add_psql_arguments(parser, required=True)
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if not options.verbose else (
+        logging.INFO if options.verbose == 1 else logging.DEBUG),
+        format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+    users = set()
+    usergroups = {}
+    if options.users:
+        users, usergroups = read_users(options.users)
+    LeaderboardHandler.board = Leaderboard(
+        lambda: connect(options), options.table, options.ts_table, Weights(options.weights),
+        users, usergroups, options.interval)
+    # Preparing files before the first request
+    LeaderboardHandler.board.refresh()
+    server = ThreadingHTTPServer((options.host, options.port), LeaderboardHandler)
+    logging.info('Listening on http://%s:%s/', options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
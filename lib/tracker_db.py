@@ -0,0 +1,174 @@
+import io
+import struct
+from datetime import datetime, timezone
+
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+# Increases with every added row, so that aggregates can read only rows added since
+# the last update. Loaders never set it, inserting only the listed columns.
+ROW_ID_COLUMN = ('row_id', 'bigserial')
+COPY_HEADER = b'PGCOPY\n\xff\r\n\0' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+
+
+def encode_timestamp(value):
+    """Encodes '2021-10-08 12:34:56+00' as microseconds since 2000-01-01."""
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S+00').replace(tzinfo=timezone.utc)
+    delta = value - PG_EPOCH
+    return struct.pack('!q', (delta.days * 86400 + delta.seconds) * 1000000 +
+                       delta.microseconds)
+
+
+def encode_text(value):
+    return str(value).encode('utf-8')
+
+
+def encode_integer(value):
+    return struct.pack('!i', int(value))
+
+
+def encode_double(value):
+    return struct.pack('!d', float(value))
+
+
+ENCODERS = {
+    'timestamp': encode_timestamp,
+    'text': encode_text,
+    'integer': encode_integer,
+    'double': encode_double,
+}
+
+
+def create_table_sql(table, columns):
+    """Returns statements to create a tracker table partitioned by weeks, and its indexes."""
+    cols = ',\n'.join(f'    {c[0]} {c[1]}' for c in columns + [ROW_ID_COLUMN])
+    return [
+        f"create table if not exists {table} (\n{cols}\n) partition by range (ts)",
+        # Unique indexes on a partitioned table must include the partition key.
+        f"create unique index if not exists idx_{table} on {table} "
+        "(osm_id, version, kind, ts)",
+        f"create index if not exists idx_{table}_region on {table} (region, ts)",
+    ]
+
+
+def create_partitions_sql(table, source):
+    """
+    Returns a statement that creates weekly partitions of the table for all
+    timestamps in the source table. Does nothing for tables made before partitioning.
+    """
+    return f"""do $$
+declare
+    week date;
+begin
+    if not exists (select 1 from pg_partitioned_table
+                   where partrelid = '{table}'::regclass) then
+        return;
+    end if;
+    for week in select distinct date_trunc('week', ts at time zone 'UTC')::date
+                from {source} loop
+        execute format(
+            'create table if not exists %I partition of %I for values from (%L) to (%L)',
+            '{table}_' || to_char(week, 'YYYYMMDD'), '{table}',
+            week::text || ' 00:00+00', (week + 7)::text || ' 00:00+00');
+    end loop;
+end $$"""
+
+
+def add_row_id(cur, table):
+    """Adds the row_id column to a tracker table made before it was introduced."""
+    cur.execute("""select 1 from information_schema.columns
+        where table_name = %s and column_name = %s""", (table, ROW_ID_COLUMN[0]))
+    if not cur.fetchone():
+        cur.execute(f"alter table {table} add column {ROW_ID_COLUMN[0]} {ROW_ID_COLUMN[1]}")
+
+
+def add_psql_arguments(parser, required=False):
+    psql = parser.add_argument_group('PostgreSQL connection')
+    psql.add_argument('-d', '--database', required=required, help='PSQL database name')
+    psql.add_argument('-H', '--dbhost', help='PSQL hostname, default is localhost')
+    psql.add_argument('-P', '--dbport', type=int, help='PSQL port, default is 5432')
+    psql.add_argument('-U', '--dbuser', help='PSQL user')
+    psql.add_argument('-W', '--dbpass', help='PSQL password')
+
+
+def connect(options):
+    import psycopg2
+    return psycopg2.connect(
+        dbname=options.database,
+        user=options.dbuser,
+        password=options.dbpass,
+        host=options.dbhost,
+        port=options.dbport,
+    )
+
+
+class TrackerLoader:
+    """
+    Loads rows straight into a tracker table with binary COPY.
+    Rows go to an unlogged staging table first, and then are merged
+    with "on conflict do nothing", so duplicate rows are skipped.
+    """
+    def __init__(self, conn, table, columns):
+        self.conn = conn
+        self.table = table
+        self.staging = f'{table}_staging'
+        self.columns = columns
+        self.encoders = [ENCODERS[c[1].split()[0]] for c in columns]
+        self.prepared = False
+
+    def table_exists(self, cur, table):
+        cur.execute("select to_regclass(%s) is not null", (table,))
+        return cur.fetchone()[0]
+
+    def prepare(self):
+        """Creates the tracker table, its indexes and the staging table if missing."""
+        with self.conn.cursor() as cur:
+            if not self.table_exists(cur, self.table):
+                for sql in create_table_sql(self.table, self.columns):
+                    cur.execute(sql)
+            if self.table_exists(cur, self.staging):
+                # Staging tables copied from the tracker table took row_id values from it
+                cur.execute(f"alter table {self.staging} drop column if exists {ROW_ID_COLUMN[0]}")
+            else:
+                # Only data columns, so that row_id values are taken once, when inserting
+                cols = ', '.join(f'{c[0]} {c[1]}' for c in self.columns)
+                cur.execute(f"create unlogged table {self.staging} ({cols})")
+        self.conn.commit()
+        self.prepared = True
+
+    def encode(self, rows):
+        buf = io.BytesIO()
+        buf.write(COPY_HEADER)
+        field_count = struct.pack('!h', len(self.columns))
+        for row in rows:
+            buf.write(field_count)
+            for col, encoder in zip(self.columns, self.encoders):
+                value = row.get(col[0])
+                if value is None or value == '':
+                    buf.write(struct.pack('!i', -1))
+                else:
+                    data = encoder(value)
+                    buf.write(struct.pack('!i', len(data)))
+                    buf.write(data)
+        buf.write(COPY_TRAILER)
+        buf.seek(0)
+        return buf
+
+    def load(self, rows):
+        """Loads rows into the tracker table in one transaction. Returns the number added."""
+        if not self.prepared:
+            self.prepare()
+        col_names = ','.join(c[0] for c in self.columns)
+        with self.conn.cursor() as cur:
+            cur.execute(f"truncate {self.staging}")
+            cur.copy_expert(
+                f"copy {self.staging} ({col_names}) from stdin (format binary)",
+                self.encode(rows))
+            cur.execute(create_partitions_sql(self.table, self.staging))
+            cur.execute(f"insert into {self.table} ({col_names}) "
+                        f"select {col_names} from {self.staging} on conflict do nothing")
+            added = cur.rowcount
+            cur.execute(f"truncate {self.staging}")
+        self.conn.commit()
+        return added
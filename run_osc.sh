@@ -8,6 +8,21 @@ REGIONS="${3-}"
 cd "$(dirname "$0")"
 PSQL=( psql "$DBNAME" -v ON_ERROR_STOP=1 )
 PYTHON=venv/bin/python
+# Set METRICS_DIR to keep timings for every sequence, and node_exporter textfiles
+METRICS_DIR="${METRICS_DIR-}"
+# Set PROFILE_DIR to record stack samples of runs slower than PROFILE_MIN_SECONDS
+PROFILE_DIR="${PROFILE_DIR-}"
+PROFILE_MIN_SECONDS="${PROFILE_MIN_SECONDS:-300}"
+# Set ARCHIVE_DIR to keep actions of every sequence as compact change records
+ARCHIVE_DIR="${ARCHIVE_DIR-}"
+# Set CONTESTS to a contests file to process all of them in one pass, instead of tags and regions
+if [ -n "${CONTESTS-}" ]; then
+    OSC_FILTERS=( -c "$CONTESTS" )
+    ADIFF_FILTERS=( -c "$CONTESTS" )
+else
+    OSC_FILTERS=( -t "$TAGS" ${REGIONS:+-r "$REGIONS"} )
+    ADIFF_FILTERS=( -t "$TAGS" ${REGIONS:+-r "$REGIONS"} -p osc_tracker )
+fi
 NEXT_SEQ="$(${PSQL[@]} -qAtc 'select ts + 1 from osc_tracker_ts order by ts desc limit 1')"
 REPLICATION='https://planet.openstreetmap.org/replication/hour'
 SEQ="$(curl -s "$REPLICATION/state.txt" | grep sequenceNumber | cut -d = -f 2)"
@@ -17,8 +32,13 @@ for ts in $(seq $NEXT_SEQ $SEQ); do
     URL="$REPLICATION/000/$(printf %03d $(($ts/1000)))/$(printf %03d $(($ts%1000))).osc.gz"
     echo "$(date +%H:%M:%S): $URL"
     curl -s --fail "$URL" > $ts.osc.gz
-    $PYTHON lib/osc_to_adiff.py process -d "$DBNAME" -t "$TAGS" ${REGIONS+-r "$REGIONS"} $ts.osc.gz -a $ts.adiff
-    $PYTHON lib/adiff_to_csv.py -t "$TAGS" -p osc_tracker ${REGIONS+-r "$REGIONS"} $ts.adiff | ${PSQL[@]} -qAt
+    $PYTHON osm-changes-counter process -d "$DBNAME" "${OSC_FILTERS[@]}" $ts.osc.gz -a $ts.adiff -j "${JOBS:-1}" \
+      ${ARCHIVE_DIR:+-b "$ARCHIVE_DIR/$ts.chr"} \
+      ${METRICS_DIR:+--metrics "$METRICS_DIR/metrics.jsonl" --prometheus "$METRICS_DIR/osc_to_adiff.prom"} \
+      ${PROFILE_DIR:+--profile "$PROFILE_DIR/$ts.osc_to_adiff.folded" --profile-mode sample --profile-min-seconds "$PROFILE_MIN_SECONDS"}
+    $PYTHON osm-changes-counter extract "${ADIFF_FILTERS[@]}" -d "$DBNAME" $ts.adiff \
+      ${METRICS_DIR:+--metrics "$METRICS_DIR/metrics.jsonl" --prometheus "$METRICS_DIR/adiff_to_csv.prom"} \
+      ${PROFILE_DIR:+--profile "$PROFILE_DIR/$ts.adiff_to_csv.folded" --profile-mode sample --profile-min-seconds "$PROFILE_MIN_SECONDS"}
     rm $ts.osc.gz
     rm $ts.adiff
     ${PSQL[@]} -qAtc "insert into osc_tracker_ts (ts) values ($ts);"
@@ -1,14 +1,19 @@
 #!/bin/bash
 set -euo pipefail
-[ $# -lt 2 ] && echo "Usage: $0 {psql_database_name|csv_file} <output.html> [<weights.lst> [<uids.csv>]]" && exit 1
+[ $# -lt 2 ] && echo "Usage: $0 {psql_database_name|csv_file} {<output.html>|<output_dir>/} [<weights.lst> [<uids.csv>]]" && exit 1
 cd "$(dirname "$0")"
 PYTHON=venv/bin/python
 CSV_ARG=
 [ "${2##*.}" == "csv" ] && CSV_ARG="--csv"
+# Optional filters from the environment: FROM=2021-10-04 TO=2021-10-11 REGION=Москва
+FILTER_ARGS=()
+[ -n "${FROM-}" ] && FILTER_ARGS+=( --from "$FROM" )
+[ -n "${TO-}" ] && FILTER_ARGS+=( --to "$TO" )
+[ -n "${REGION-}" ] && FILTER_ARGS+=( --region "$REGION" )
+OUT_ARG=( -o "$2" )
+[ "${2: -1}" == "/" ] && OUT_ARG=( --shards "$2" )
 if [ -e "$1" ]; then
-   $PYTHON lib/generate_user_stats.py -i "$1" $CSV_ARG ${3+-w "$3"} ${4+-u "$4"} -o "$2"
+   $PYTHON osm-changes-counter stats -i "$1" $CSV_ARG ${3+-w "$3"} ${4+-u "$4"} "${OUT_ARG[@]}" ${FILTER_ARGS[@]+"${FILTER_ARGS[@]}"}
 else
-  PSQL=( psql "$1" -v ON_ERROR_STOP=1 )
-  ${PSQL[@]} -c "copy (select * from osc_tracker order by ts, osm_id, kind) to stdout (format csv, header)" \
-    | $PYTHON lib/generate_user_stats.py $CSV_ARG ${3+-w "$3"} ${4+-u "$4"} -o "$2"
+  $PYTHON osm-changes-counter stats -d "$1" $CSV_ARG ${3+-w "$3"} ${4+-u "$4"} "${OUT_ARG[@]}" ${FILTER_ARGS[@]+"${FILTER_ARGS[@]}"}
 fi